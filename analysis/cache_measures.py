@@ -0,0 +1,17 @@
+import re
+
+import pandas as pd
+from utilities import OUTPUT_DIR, write_measure_cache
+
+# Parses each measure file once and writes it to the measures cache, so that
+# later actions don't have to parse the CSV files again.
+
+measure_pattern = r"^measure_(\w*?)_(practice_only_rate|rate)\.csv$"
+
+for file in OUTPUT_DIR.iterdir():
+    match = re.match(measure_pattern, file.name)
+    if match:
+        sentinel_measure, kind = match.groups()
+        df = pd.read_csv(file, parse_dates=["date"])
+
+        write_measure_cache(df, sentinel_measure, kind)
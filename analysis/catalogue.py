@@ -0,0 +1,190 @@
+"""A catalogue of the extracts in a directory, kept in a manifest file.
+
+Extracts are recognised by name:
+
+* monthly extracts are named `input_YYYY-MM-DD.feather`
+* population extracts are named `input_population_YYYY-MM-DD.feather`
+* the ethnicity extract is named `input_ethnicity.feather`
+
+For each extract, the manifest records its kind, date, row count and Arrow schema,
+which are read from the extract's footer. An entry is reused while the extract's
+size and modification time are unchanged, so each extract is only described once.
+
+Hashing an extract reads it in full, so a hash of its contents is only added to
+its entry when asked for, and is then reused in the same way.
+
+The manifest is only written when asked for, e.g. when exploring the extracts
+locally. Pipeline actions don't write it: an action can't read its own outputs
+from an earlier run, so a manifest written by one would never be reused.
+"""
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pyarrow as pa
+
+MANIFEST_NAME = "extracts_manifest.json"
+
+DATE_PATTERN = r"(?P<date>20\d\d-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01]))"
+
+EXTRACT_PATTERNS = {
+    "monthly": rf"^input_{DATE_PATTERN}\.feather$",
+    "population": rf"^input_population_{DATE_PATTERN}\.feather$",
+    "ethnicity": r"^input_ethnicity\.feather$",
+}
+
+# the file name prefixes of the kinds of extract that have a date
+PREFIXES = {"input": "monthly", "input_population": "population"}
+
+
+def parse_extract_name(name):
+    """Gets the kind and date of an extract from its file name.
+
+    Args:
+        name: The file name, e.g. "input_2019-01-01.feather".
+
+    Returns:
+        A tuple of the kind and the date, in the format YYYY-MM-DD, or None if the
+        file isn't an extract. The date of the ethnicity extract is None.
+    """
+    for kind, pattern in EXTRACT_PATTERNS.items():
+        match = re.match(pattern, name)
+        if match:
+            return kind, match.groupdict().get("date")
+    return None
+
+
+def get_content_hash(path):
+    """Gets the SHA-256 hash of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def describe_extract(path):
+    """Describes an extract, for the manifest, without reading its contents.
+
+    Args:
+        path: The path to the extract.
+
+    Returns:
+        A manifest entry.
+    """
+    path = Path(path)
+    kind, date = parse_extract_name(path.name)
+    stat = path.stat()
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+        num_rows = sum(
+            reader.get_batch(i).num_rows for i in range(reader.num_record_batches)
+        )
+    return {
+        "name": path.name,
+        "kind": kind,
+        "date": date,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "num_rows": num_rows,
+        "schema": [[field.name, str(field.type)] for field in schema],
+    }
+
+
+def add_content_hash(entry, path):
+    """Adds the hash of an extract's contents to its manifest entry."""
+    return dict(entry, hash=get_content_hash(path))
+
+
+def load_catalogue(directory, max_workers=4, hash_kinds=(), save_manifest=False):
+    """Loads the catalogue of the extracts in a directory.
+
+    Entries are reused from the directory's manifest, if it has one. Extracts that
+    are new, or whose size or modification time has changed, are described in
+    parallel. Entries for extracts that no longer exist are dropped.
+
+    Args:
+        directory: The directory containing the extracts.
+        max_workers: The number of extracts to describe or hash concurrently.
+        hash_kinds: The kinds of extract whose entries should include a hash of
+            their contents. An extract is only hashed if its entry has no hash.
+            By default, no extracts are hashed.
+        save_manifest: Whether to write the catalogue to the directory's manifest,
+            if it has changed.
+
+    Returns:
+        A dict of file names to manifest entries.
+    """
+    directory = Path(directory)
+    manifest_path = directory / MANIFEST_NAME
+    previous = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            previous = json.load(f)
+
+    catalogue = {}
+    to_describe = []
+    for path in sorted(directory.iterdir()):
+        if parse_extract_name(path.name) is None:
+            continue
+        stat = path.stat()
+        entry = previous.get(path.name)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            catalogue[path.name] = entry
+        else:
+            to_describe.append(path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for entry in executor.map(describe_extract, to_describe):
+            catalogue[entry["name"]] = entry
+
+        to_hash = [
+            e
+            for e in catalogue.values()
+            if e["kind"] in hash_kinds and e.get("hash") is None
+        ]
+        for entry in executor.map(
+            lambda e: add_content_hash(e, directory / e["name"]), to_hash
+        ):
+            catalogue[entry["name"]] = entry
+
+    catalogue = dict(sorted(catalogue.items()))
+    if save_manifest and catalogue != previous:
+        # write alongside the manifest, then replace it, so that concurrent readers
+        # never see a partial manifest
+        tmp_path = manifest_path.with_name(f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(catalogue, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    return catalogue
+
+
+def get_extracts(directory, kind, hashes=False, save_manifest=False):
+    """Gets the manifest entries of the extracts of a kind, sorted by date.
+
+    Args:
+        directory: The directory containing the extracts.
+        kind: "monthly", "population", or "ethnicity".
+        hashes: Whether to include the hash of each extract's contents, as "hash".
+        save_manifest: Whether to write the catalogue to the directory's manifest.
+
+    Returns:
+        A list of manifest entries, with the path to each extract as "path".
+    """
+    return [
+        dict(entry, path=Path(directory) / name)
+        for name, entry in load_catalogue(
+            directory,
+            hash_kinds=[kind] if hashes else (),
+            save_manifest=save_manifest,
+        ).items()
+        if entry["kind"] == kind
+    ]
@@ -0,0 +1,550 @@
+"""Charts and notebook display helpers.
+
+These are kept apart from `utilities`, so that scripts that don't draw charts don't
+import matplotlib, seaborn, plotly or IPython. `from utilities import ...` still
+works for everything here: it is imported on first use.
+"""
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+import seaborn as sns
+from disclosure import Policy
+from IPython.display import HTML, Markdown, display
+from matplotlib.collections import LineCollection
+from utilities import (
+    OUTPUT_DIR,
+    apply_code_counts_policy,
+    create_child_table,
+    get_change_classifications,
+    get_code_counts,
+    get_deciles,
+    get_number_events_mil,
+    get_number_patients,
+    get_number_practices,
+    get_percentage_practices,
+    save_code_counts,
+)
+
+# Legend locations for matplotlib
+# https://github.com/ebmdatalab/datalab-pandas/blob/master/ebmdatalab/charts.py
+BEST = 0
+UPPER_RIGHT = 1
+UPPER_LEFT = 2
+LOWER_LEFT = 3
+LOWER_RIGHT = 4
+RIGHT = 5
+CENTER_LEFT = 6
+CENTER_RIGHT = 7
+LOWER_CENTER = 8
+UPPER_CENTER = 9
+CENTER = 10
+
+
+# https://github.com/ebmdatalab/datalab-pandas/blob/master/ebmdatalab/charts.py
+def deciles_chart_ebm(
+    df,
+    period_column=None,
+    column=None,
+    title="",
+    ylabel="",
+    show_outer_percentiles=True,
+    show_legend=True,
+    ax=None,
+    output_path=None,
+    percentiles=None,
+    show=True,
+):
+    """period_column must be dates / datetimes
+
+    If `percentiles` is given, it is plotted instead of computing the percentiles
+    of `df`. Pass `show=False` when rendering without a notebook.
+    """
+    sns.set_style("whitegrid", {"grid.color": ".9"})
+    if not ax:
+        fig, ax = plt.subplots(1, 1)
+    if percentiles is None:
+        percentiles = get_deciles(df, period_column, column, show_outer_percentiles)
+    linestyles = {
+        "decile": {
+            "linestyle": "--",
+            "linewidth": 1,
+            "label": "decile",
+        },
+        "median": {
+            "linestyle": "-",
+            "linewidth": 1.5,
+            "label": "median",
+        },
+        "percentile": {
+            "linestyle": ":",
+            "linewidth": 0.8,
+            "label": "1st-9th, 91st-99th percentile",
+        },
+    }
+
+    # a row per date and a column per percentile
+    table = pivot_percentiles(percentiles, period_column, column)
+    dates = matplotlib.dates.date2num(table.index.to_numpy())
+    values = table.to_numpy(dtype=float)
+
+    # draw the lines of each style as one collection, in the order in which their
+    # first percentile appears, so that the legend is in that order too
+    styles = {}
+    for i, percentile in enumerate(table.columns):
+        if percentile == 50:
+            style = "median"
+        elif show_outer_percentiles and (percentile < 10 or percentile > 90):
+            style = "percentile"
+        else:
+            style = "decile"
+        styles.setdefault(style, []).append(i)
+
+    ax.xaxis_date()
+    for style, columns in styles.items():
+        lines = np.stack(
+            [np.broadcast_to(dates, (len(columns), len(dates))), values[:, columns].T],
+            axis=-1,
+        )
+        ax.add_collection(
+            LineCollection(
+                lines,
+                colors="b",
+                linestyles=linestyles[style]["linestyle"],
+                linewidths=linestyles[style]["linewidth"],
+                label=linestyles[style]["label"],
+            )
+        )
+    ax.set_ylabel(ylabel, size=15, alpha=0.6)
+    if title:
+        ax.set_title(title, size=18)
+
+    # Ignore infinite and missing values when setting the axis ranges
+    is_finite = np.isfinite(values)
+    if is_finite.any():
+        ax.set_ylim([0, values[is_finite].max() * 1.05])
+
+    ax.tick_params(labelsize=12)
+
+    dates_with_values = table.index[is_finite.any(axis=1)]
+    if not dates_with_values.empty:
+        ax.set_xlim(
+            [dates_with_values.min(), dates_with_values.max()]
+        )  # set x axis range as full date range
+
+    ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%B %Y"))
+    ax.xaxis.set_major_locator(matplotlib.dates.MonthLocator(interval=1))
+    if show_legend:
+        ax.legend(
+            bbox_to_anchor=(1.05, 0.6),
+            ncol=1,
+            fontsize=12,
+            borderaxespad=0.0,
+            frameon=True,
+        )
+
+    # rotates and right aligns the x labels, and moves the bottom of the
+    # axes up to make room for them
+    ax.get_figure().autofmt_xdate(rotation=90, ha="center", which="both")
+
+    if show:
+        plt.show()
+
+    if output_path:
+        ax.get_figure().savefig(output_path, bbox_inches="tight")
+
+    return plt
+
+
+def pivot_percentiles(percentiles, period_column, column):
+    """Pivots a percentile table into a table with a row per date and a column per
+    percentile, sorted by date and percentile.
+    """
+    return percentiles.pivot(index=period_column, columns="percentile", values=column)
+
+
+def get_line_gaps(x, values):
+    """Joins lines into one line, with a gap between each of them.
+
+    Args:
+        x: The x values of the points on each line.
+        values: A 2-D array with a row per x value and a column per line.
+
+    Returns:
+        Arrays of x and y values, with a missing value between each line.
+    """
+    num_points, num_lines = values.shape
+    if np.issubdtype(np.asarray(x).dtype, np.floating):
+        x = np.append(x, np.nan)
+    else:
+        x = np.append(np.asarray(x, dtype=object), None)
+    y = np.vstack([values, np.full((1, num_lines), np.nan)]).T.ravel()
+    return np.tile(x, num_lines), y
+
+
+def get_deciles_figure(
+    table,
+    title="",
+    ylabel="",
+    width=800,
+    height=400,
+    outer_percentiles="lines",
+    compact=False,
+    decimals=3,
+):
+    """Makes an interactive chart of the percentiles in a pivoted percentile table.
+
+    Args:
+        table: A table with a row per date and a column per percentile, as returned by
+            `pivot_percentiles`.
+        title: The title of the chart.
+        ylabel: The label of the y axis.
+        width: The width of the chart, in pixels.
+        height: The height of the chart, in pixels.
+        outer_percentiles: How to draw the 1st-9th and 91st-99th percentiles: "lines"
+            draws a line for each, "band" shades the range between the 1st and 99th
+            percentiles, and None leaves them out.
+        compact: Whether to make the figure small to embed, by giving dates as
+            milliseconds since the epoch and rounding values to `decimals` places.
+            These are shorter than date strings with the pinned Plotly, and are
+            serialised as typed binary arrays from Plotly 6.
+        decimals: The number of decimal places to round values to, when `compact`.
+
+    Returns:
+        A Plotly figure.
+    """
+    if outer_percentiles not in ("lines", "band", None):
+        raise ValueError(f"Unknown outer_percentiles: {outer_percentiles!r}")
+
+    values = table.to_numpy(dtype=float)
+    if compact:
+        x = table.index.to_numpy().astype("datetime64[ms]").astype(np.int64)
+        x = x.astype(float)
+        values = values.round(decimals)
+    else:
+        x = table.index
+
+    fig = go.Figure()
+
+    # draw the lines of each style as one trace, with gaps between the lines
+    percentiles = list(table.columns)
+    is_outer = [p < 10 or p > 90 for p in percentiles]
+    styles = {
+        "median": (
+            [p == 50 for p in percentiles],
+            {"color": "blue", "dash": "solid", "width": 1.2},
+        ),
+        "deciles": (
+            [p != 50 and not outer for p, outer in zip(percentiles, is_outer)],
+            {"color": "blue", "dash": "dash", "width": 1},
+        ),
+    }
+    if outer_percentiles == "lines":
+        styles["1st-9th, 91st-99th percentile"] = (
+            is_outer,
+            {"color": "blue", "dash": "dot", "width": 1},
+        )
+    for name, (columns, line) in styles.items():
+        if not any(columns):
+            continue
+        x_gaps, y_gaps = get_line_gaps(x, values[:, columns])
+        # label each point with its percentile, as the lines share a trace. Hover
+        # shows the closest point, as "x" hover would show one point per trace
+        line_percentiles = np.array(percentiles)[columns]
+        fig.add_trace(
+            go.Scattergl(
+                x=x_gaps,
+                y=y_gaps,
+                customdata=np.repeat(line_percentiles, len(x) + 1),
+                hovertemplate="%{x|%b %Y}<br>percentile %{customdata}: %{y}",
+                mode="lines",
+                line=line,
+                name=name,
+            )
+        )
+
+    if outer_percentiles == "band" and 1 in percentiles and 99 in percentiles:
+        # a closed outline, below the 99th percentile and back above the 1st
+        lowest = values[:, percentiles.index(1)]
+        highest = values[:, percentiles.index(99)]
+        fig.add_trace(
+            go.Scattergl(
+                x=np.concatenate([x, x[::-1]]),
+                y=np.concatenate([highest, lowest[::-1]]),
+                mode="lines",
+                fill="toself",
+                fillcolor="rgba(0, 0, 255, 0.1)",
+                line={"width": 0},
+                hoverinfo="skip",
+                name="1st-99th percentile",
+            )
+        )
+
+    # Set title
+    fig.update_layout(
+        title_text=title,
+        hovermode="closest",
+        title_x=0.5,
+        width=width,
+        height=height,
+    )
+
+    fig.update_yaxes(title=ylabel)
+    fig.update_xaxes(title="Date")
+
+    # Add range slider
+    fig.update_layout(
+        xaxis=go.layout.XAxis(
+            rangeselector=dict(
+                buttons=list(
+                    [
+                        dict(
+                            count=1,
+                            label="1m",
+                            step="month",
+                            stepmode="backward",
+                        ),
+                        dict(
+                            count=6,
+                            label="6m",
+                            step="month",
+                            stepmode="backward",
+                        ),
+                        dict(
+                            count=1,
+                            label="1y",
+                            step="year",
+                            stepmode="backward",
+                        ),
+                        dict(step="all"),
+                    ]
+                )
+            ),
+            rangeslider=dict(visible=True),
+            type="date",
+        )
+    )
+    return fig
+
+
+def display_plotlyjs():
+    """Displays Plotly's JavaScript, for figures displayed with `compact=True`.
+
+    Call this once, in a cell whose output is shown, before any compact figures.
+    Whether Plotly's JavaScript is embedded then depends on the notebook's output,
+    rather than on state that is also changed by cells whose output is discarded.
+    """
+    display(
+        HTML(f'<script type="text/javascript">{plotly.offline.get_plotlyjs()}</script>')
+    )
+
+
+def display_figure(fig, compact=False):
+    """Displays a Plotly figure.
+
+    Args:
+        fig: A Plotly figure.
+        compact: Whether to display the figure as HTML that doesn't embed Plotly's
+            JavaScript, rather than with `fig.show()`. This keeps notebooks converted
+            to HTML small, but `display_plotlyjs` must be called first.
+    """
+    if not compact:
+        fig.show()
+        return
+    display(HTML(fig.to_html(full_html=False, include_plotlyjs=False)))
+
+
+def deciles_chart(
+    df,
+    period_column=None,
+    column=None,
+    title="",
+    ylabel="",
+    interactive=True,
+    width=800,
+    height=400,
+    output_path=None,
+    percentiles=None,
+    compact_html=False,
+    outer_percentiles="lines",
+):
+    """period_column must be dates / datetimes
+
+    If `percentiles` is given, it is plotted instead of computing the percentiles
+    of `df`. When `interactive`, `compact_html` and `outer_percentiles` are passed to
+    `get_deciles_figure` and `display_figure`.
+    """
+
+    if percentiles is None:
+        percentiles = get_deciles(df, period_column, column, True)
+    df = percentiles
+
+    if interactive:
+        fig = get_deciles_figure(
+            pivot_percentiles(df, period_column, column),
+            title=title,
+            ylabel=ylabel,
+            width=width,
+            height=height,
+            outer_percentiles=outer_percentiles,
+            compact=compact_html,
+        )
+        display_figure(fig, compact=compact_html)
+
+    else:
+        px = 1 / plt.rcParams["figure.dpi"]  # pixel in inches
+        fig, ax = plt.subplots(
+            1, 1, figsize=(width * px, height * px), tight_layout=True
+        )
+
+        deciles_chart_ebm(
+            df,
+            period_column=period_column,
+            column=column,
+            ylabel="rate per 1000",
+            show_outer_percentiles=True,
+            ax=ax,
+            output_path=output_path,
+            percentiles=df,
+        )
+
+
+def generate_sentinel_measure(
+    data_dict,
+    data_dict_practice,
+    codelist_dict,
+    measure,
+    code_column,
+    term_column,
+    dates_list,
+    codelist_links,
+    interactive=True,
+    compact_html=False,
+    outer_percentiles="lines",
+):
+    """Generates tables and charts for the measure with the given ID.
+
+    Args:
+        data_dict: A mapping of measure IDs to measure tables.
+        data_dict_practice: A mapping of measure IDs to "practice only" measure tables.
+        codelist_dict: A mapping of measure IDs to codelist tables.
+        measure: A measure ID.
+        code_column: The name of the code column in the codelist table.
+        term_column: The name of the term column in the codelist table.
+        dates_list: Not used.
+        interactive: Flag indicating whether or not the chart should be interactive.
+        compact_html: Flag indicating whether or not an interactive chart should be
+            displayed as compact HTML. See `display_figure`.
+        outer_percentiles: How an interactive chart should draw the outer
+            percentiles. See `get_deciles_figure`.
+    """
+    df = data_dict[measure]
+
+    childs_df, childs_df_with_count = create_child_table(
+        df, codelist_dict[measure], code_column, term_column, measure
+    )
+
+    # the event counts of every code, which can be merged across backends. They are
+    # released, so disclosure control is applied before they are saved
+    save_code_counts(
+        *apply_code_counts_policy(
+            *get_code_counts(df, f"{measure}_event_code", measure),
+            Policy(threshold=10, base=5),
+        ),
+        f"{OUTPUT_DIR}/code_counts_{measure}.csv",
+    )
+
+    practices_included = get_number_practices(df)
+    practices_included_percent = get_percentage_practices(df)
+
+    num_events, num_events_mil = get_number_events_mil(df, measure)
+
+    num_patients = get_number_patients(measure)
+
+    num_practices_df = pd.DataFrame(
+        {"num_practices_included": pd.Series([practices_included])}
+    )
+    num_practices_df.to_csv(
+        f"{OUTPUT_DIR}/num_practices_included_{measure}.csv", index=False
+    )
+
+    df = data_dict_practice[measure]
+
+    deciles_chart(
+        df,
+        period_column="date",
+        column="rate",
+        ylabel="rate per 1000",
+        interactive=interactive,
+        compact_html=compact_html,
+        outer_percentiles=outer_percentiles,
+    )
+
+    display(
+        Markdown(
+            f"Practices included: {practices_included} "
+            f"({practices_included_percent:.2f}%)"
+        ),
+    )
+
+    childs_df = childs_df.rename(columns={code_column: code_column.title()})
+    childs_df.to_csv(f"{OUTPUT_DIR}/code_table_{measure}.csv")
+
+    childs_df_with_count = childs_df_with_count.rename(
+        columns={code_column: code_column.title()}
+    )
+    childs_df_with_count.to_csv(f"{OUTPUT_DIR}/code_table_{measure}_with_count.csv")
+
+    if len(codelist_links) > 1:
+        display(
+            Markdown(
+                f"#### Most Common Codes <a href={codelist_links[0]}>(Codelist 1)</a>, "
+                f"<a href={codelist_links[1]}>(Codelist 2)</a>"
+            ),
+            HTML(childs_df.to_html(index=False)),
+        )
+
+    else:
+        display(
+            Markdown(
+                f"#### Most Common Codes <a href={codelist_links[0]}>(Codelist)</a>"
+            ),
+            HTML(childs_df.to_html(index=False)),
+        )
+
+    display(
+        Markdown(f"Total patients: {num_patients:.2f}M ({num_events_mil:.2f}M events)"),
+    )
+
+    return df, num_events
+
+
+def classify_changes(changes):
+    """Classifies list of % changes
+
+    Args:
+        changes: list of percentage changes
+    """
+
+    (classification,) = get_change_classifications([changes[0]], [changes[1]])
+
+    display(Markdown(f"Overall classification: **{classification}**"))
+
+
+def display_changes(baseline, values, changes, dates):
+    """Display % changes at given dates
+
+    Args:
+        changes: list of % changes
+        dates: list of readable dates changes refer to
+    """
+
+    for value, change, date in zip(values, changes, dates):
+        display(
+            Markdown(
+                f"Change in median from April 2019 ({baseline}) - {date} ({value}): "
+                f"**{change}%**"
+            )
+        )
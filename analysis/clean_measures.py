@@ -1,21 +1,25 @@
 import re
-import pandas as pd
-from pathlib import Path
-from utilities import calculate_rate, drop_irrelevant_practices, load_and_drop, OUTPUT_DIR, produce_stripped_measures
 
+from sketches import save_sketches, sketch_by_date
+from utilities import OUTPUT_DIR, load_and_drop
 
-measure_pattern = r'^measure_\w*_practice_only_rate.csv'
+measure_pattern = r"^measure_\w*_practice_only_rate.csv"
 
 for file in OUTPUT_DIR.iterdir():
     if re.match(measure_pattern, file.name):
-        
-        sentinel_measure = re.search(r'measure_(.*)\_practice_only_rate.csv', file.name).group(1)
+
+        sentinel_measure = re.search(
+            r"measure_(.*)\_practice_only_rate.csv", file.name
+        ).group(1)
         df = load_and_drop(sentinel_measure, practice=True)
-        
 
         df.to_csv(OUTPUT_DIR / f"measure_cleaned_{sentinel_measure}.csv", index=False)
-        
-
-
-
 
+        # a sketch of the rates for each month, which can be merged across backends.
+        # A month's sketch holds at most the month's rates in the cleaned measure,
+        # which are already rounded, shuffled and without practice IDs, so it
+        # releases nothing that the cleaned measure doesn't
+        save_sketches(
+            sketch_by_date(df, "date", "rate"),
+            OUTPUT_DIR / f"sketch_{sentinel_measure}.json",
+        )
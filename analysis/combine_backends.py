@@ -1,9 +1,24 @@
-# Use to combine results across backends.
+"""Combines the outputs of any number of backends.
+
+Each backend's outputs are read from a directory named after the backend, within
+`--input-dir`. For example:
+
+    python analysis/combine_backends.py --backend emis --backend tpp
+
+The count table of each demographic is harmonised across backends as described in
+`DEMOGRAPHICS`, and the code tables and percentiles of the sentinel measures are
+combined in parallel. Disclosure control is applied to the combined counts, as well
+as to each backend's code counts before they are released.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-import pandas as pd
-from utilities import BASE_DIR
-import json
 import numpy as np
+import pandas as pd
+from disclosure import Policy, apply_policy
+from sketches import get_sketch_deciles, load_sketches, merge_sketches, save_sketches
+from utilities import BASE_DIR, load_code_counts, load_codelist_terms, merge_code_counts
 
 sentinel_measures = [
     "qrisk2",
@@ -13,184 +28,265 @@ sentinel_measures = [
     "cholesterol",
     "alt",
     "tsh",
-    "alt",
     "rbc",
     "hba1c",
     "systolic_bp",
     "medication_review",
 ]
 
-demographics = ["age_band", "ethnicity", "imd", "region", "sex", "total"]
-
-for d in demographics:
-    emis_count = pd.read_csv(f"backend_outputs/emis/{d}_count.csv", index_col=0)
-    tpp_count = pd.read_csv(f"backend_outputs/tpp/{d}_count.csv", index_col=0)
-
-    if d == "ethnicity":
-        # map emis ethnicity to 6 categories
-        mapping = {
-            1: 1,
-            2: 1,
-            3: 1,
-            4: 2,
-            5: 2,
-            6: 2,
-            7: 2,
-            8: 3,
-            9: 3,
-            10: 3,
-            11: 3,
-            12: 4,
-            13: 4,
-            14: 4,
-            15: 5,
-            16: 5,
-        }
-        emis_count.index = emis_count.index.map(mapping)
-        emis_count = emis_count.groupby(level=0).sum()
-
-    if d == "region":
-
-        mapping_tpp = {
-            "East Midlands": "Midlands",
-            "Yorkshire and The Humber": "North East",
-            "North West": "North West",
-            "North East": "North East",
-            "East": "East",
-            "London": "London",
-            "South East": "South East",
-            "South West": "South West",
-            "West Midlands": "Midlands",
-        }
-
-        mapping_emis = {
-            "NORTH EAST AND YORKSHIRE COMMISSIONING REGION": "North East",
-            "LONDON COMMISSIONING REGION": "London",
-            "NORTH WEST COMMISSIONING REGION": "North West",
-            "SOUTH EAST COMMISSIONING REGION": "South East",
-            "EAST OF ENGLAND COMMISSIONING REGION": "East",
-            "SOUTH WEST COMMISSIONING REGION": "South West",
-            "MIDLANDS COMMISSIONING REGION": "Midlands",
-        }
-
-        emis_count.index = emis_count.index.map(mapping_emis)
-        emis_count = emis_count.groupby(level=0).sum()
-
-        tpp_count.index = tpp_count.index.map(mapping_tpp)
-        tpp_count = tpp_count.groupby(level=0).sum()
-
-    if d == "total":
-        emis_count.set_index("pop", drop=True, inplace=True)
-        tpp_count.set_index("pop", drop=True, inplace=True)
-
-    combined_count = emis_count.sort_index().add(tpp_count.sort_index())
-    combined_count.to_csv(f"backend_outputs/{d}_count.csv")
-
-
-with open("backend_outputs/tpp/event_count.json") as f:
-    num_events_tpp = json.load(f)["num_events"]
-with open("backend_outputs/emis/event_count.json") as f:
-    num_events_emis = json.load(f)["num_events"]
-
-total_count = {}
-
-for key, value in num_events_tpp.items():
-    count = value + num_events_emis[key]
-    total_count[key] = count
-
-
-for measure in sentinel_measures:
-    code_table_path_emis = BASE_DIR / f"backend_outputs/emis/code_table_{measure}.csv"
-    code_table_path_tpp = BASE_DIR / f"backend_outputs/tpp/code_table_{measure}.csv"
-
-    code_table_emis = pd.read_csv(code_table_path_emis)
-    code_table_tpp = pd.read_csv(code_table_path_tpp)
-
-    code_table_combined = pd.merge(
-        code_table_emis,
-        code_table_tpp,
-        how="outer",
-        on="Code",
-        suffixes=("_emis", "_tpp"),
+# map emis ethnicity to 6 categories
+ETHNICITY_16_TO_6 = {
+    1: 1,
+    2: 1,
+    3: 1,
+    4: 2,
+    5: 2,
+    6: 2,
+    7: 2,
+    8: 3,
+    9: 3,
+    10: 3,
+    11: 3,
+    12: 4,
+    13: 4,
+    14: 4,
+    15: 5,
+    16: 5,
+}
+
+REGIONS = {
+    "tpp": {
+        "East Midlands": "Midlands",
+        "Yorkshire and The Humber": "North East",
+        "North West": "North West",
+        "North East": "North East",
+        "East": "East",
+        "London": "London",
+        "South East": "South East",
+        "South West": "South West",
+        "West Midlands": "Midlands",
+    },
+    "emis": {
+        "NORTH EAST AND YORKSHIRE COMMISSIONING REGION": "North East",
+        "LONDON COMMISSIONING REGION": "London",
+        "NORTH WEST COMMISSIONING REGION": "North West",
+        "SOUTH EAST COMMISSIONING REGION": "South East",
+        "EAST OF ENGLAND COMMISSIONING REGION": "East",
+        "SOUTH WEST COMMISSIONING REGION": "South West",
+        "MIDLANDS COMMISSIONING REGION": "Midlands",
+    },
+}
+
+# How to read each backend's `{demographic}_count.csv`. "index" is the column of
+# categories, if it isn't the first column. "mappings" maps the categories of a
+# backend to the combined categories; categories that aren't mapped are dropped,
+# and the categories of a backend without a mapping are used as they are.
+DEMOGRAPHICS = {
+    "age_band": {},
+    "ethnicity": {"mappings": {"emis": ETHNICITY_16_TO_6}},
+    "imd": {},
+    "region": {"mappings": REGIONS},
+    "sex": {},
+    "total": {"index": "pop"},
+}
+
+
+class CategoryCounts:
+    """Sums count tables by category, e.g. across backends.
+
+    The categories of each table are converted to integer codes into the categories
+    seen so far, and its counts are added to the rows of those codes.
+    """
+
+    def __init__(self):
+        self.categories = pd.Index([])
+        self.columns = None
+        self.counts = None
+
+    def add(self, table):
+        """Adds a table of counts, with a row per category."""
+        if self.columns is None:
+            self.categories = self.categories.rename(table.index.name)
+            self.columns = table.columns
+            self.counts = np.zeros((0, len(self.columns)))
+
+        new = table.index.unique().difference(self.categories)
+        self.categories = self.categories.append(new)
+        self.counts = np.vstack([self.counts, np.zeros((len(new), len(self.columns)))])
+
+        codes = self.categories.get_indexer(table.index)
+        np.add.at(self.counts, codes, table[self.columns].to_numpy(dtype=float))
+
+    def to_frame(self):
+        """Gets the summed counts, sorted by category."""
+        return pd.DataFrame(
+            self.counts, index=self.categories, columns=self.columns
+        ).sort_index()
+
+
+def read_count_table(input_path, spec, backend):
+    """Reads a backend's count table of a demographic, harmonising its categories.
+
+    Args:
+        input_path: The path to the count table.
+        spec: The demographic's entry in `DEMOGRAPHICS`.
+        backend: The name of the backend.
+
+    Returns:
+        A table of counts, with a row per combined category.
+    """
+    table = pd.read_csv(input_path, index_col=0)
+    if "index" in spec:
+        table = table.set_index(spec["index"])
+    mapping = spec.get("mappings", {}).get(backend)
+    if mapping is not None:
+        table.index = table.index.map(mapping)
+    return table[table.index.notna()]
+
+
+def combine_demographics(input_dir, backends, output_dir, policy):
+    """Combines the count tables of every demographic, in one pass over the backends.
+
+    Args:
+        input_dir: The directory containing a directory for each backend.
+        backends: The names of the backends.
+        output_dir: The directory to write the combined count tables to.
+        policy: The disclosure control `Policy` to apply to the combined counts.
+    """
+    totals = {demographic: CategoryCounts() for demographic in DEMOGRAPHICS}
+    for backend in backends:
+        for demographic, spec in DEMOGRAPHICS.items():
+            totals[demographic].add(
+                read_count_table(
+                    input_dir / backend / f"{demographic}_count.csv", spec, backend
+                )
+            )
+
+    for demographic, counts in totals.items():
+        combined_count = apply_policy(counts.to_frame(), policy)
+        combined_count.to_csv(output_dir / f"{demographic}_count.csv")
+
+
+def combine_code_table(measure, input_dir, backends, output_dir, policy):
+    """Combines the event counts of every code of a measure into a top 5 code table.
+
+    Args:
+        measure: The measure ID.
+        input_dir: The directory containing a directory for each backend.
+        backends: The names of the backends.
+        output_dir: The directory to write the code table to.
+        policy: The disclosure control `Policy` to apply to the combined counts.
+    """
+    # the event counts of every code, rather than each backend's top 5 codes. Each
+    # backend's counts have already had disclosure control applied
+    codes, events = merge_code_counts(
+        *(
+            load_code_counts(input_dir / backend / f"code_counts_{measure}.csv")
+            for backend in backends
+        )
     )
 
-    # checkif code in both
-
-    code_table_combined["combined_events"] = code_table_combined["Events_emis"].fillna(
-        0
-    ) + code_table_combined["Events_tpp"].fillna(0)
-
-    # calculate % makeup of each code
-    total_events = total_count[measure]
+    # disclosure control is applied again, to the combined counts, and proportions
+    # are of the total of the combined counts that are released
+    code_table_combined = pd.DataFrame(
+        {
+            "Code": codes,
+            "combined_events": apply_policy(pd.Series(events, dtype=float), policy),
+        }
+    ).dropna()
+    total_events = code_table_combined["combined_events"].sum()
 
     code_table_combined = code_table_combined.sort_values(
         by="combined_events", ascending=False
-    )
+    ).head(5)
 
-    code_table_combined = code_table_combined.head(5)
+    code_table_combined["Description"] = (
+        code_table_combined["Code"].map(load_codelist_terms(measure)).astype(str)
+    )
 
+    # calculate % makeup of each code
     code_table_combined["Proportion of Codes (%)"] = round(
         (code_table_combined["combined_events"] / total_events) * 100, 2
     )
-    code_table_combined["Description_emis"] = code_table_combined[
-        "Description_emis"
-    ].astype(str)
-    code_table_combined["Description_tpp"] = code_table_combined[
-        "Description_tpp"
-    ].astype(str)
-
-    ######
-
-    ###########
-    # # Cast the code to an integer.
-    # event_counts[code_column] = event_counts[code_column].astype(int)
-
-    # check that codes not in the top 5 rows have >5 events
-    outside_top_5_percent = 1 - (
-        (code_table_combined.head(5)["combined_events"].sum()) / total_events
-    )
-
-    if (0 < (outside_top_5_percent * total_events) <= 5) & (outside_top_5_percent != 0):
-
-        # drop percent column
-        code_table_combined = code_table_combined.loc[
-            :, ["Code", "Description_emis", "Description_tpp"]
-        ]
 
-    else:
-        # give more logical column ordering
-
-        code_table_combined = code_table_combined.loc[
-            :,
-            ["Code", "Description_emis", "Description_tpp", "Proportion of Codes (%)"],
-        ]
-
-    code_table_combined["Proportion of Codes (%)"] = code_table_combined[
-        "Proportion of Codes (%)"
-    ].round(decimals=2)
-
-    if len(code_table_combined["Code"]) > 1:
-
-        code_table_combined.loc[
-            code_table_combined["Proportion of Codes (%)"] == 0,
-            "Proportion of Codes (%)",
-        ] = "< 0.005"
-        code_table_combined.loc[
-            code_table_combined["Proportion of Codes (%)"] == 100,
-            "Proportion of Codes (%)",
-        ] = "> 99.995"
+    # the codes outside the top 5 don't need checking for small numbers of events:
+    # each combined count has had disclosure control applied, so they don't
+    # have between 1 and 9 events between them
 
+    # give more logical column ordering
     code_table_combined = code_table_combined.loc[
-        :, ["Code", "Description_tpp", "Description_emis", "Proportion of Codes (%)"]
+        :, ["Code", "Description", "Proportion of Codes (%)"]
     ]
 
-    code_table_combined.to_csv(BASE_DIR / f"backend_outputs/code_table_{measure}.csv")
+    if len(code_table_combined["Code"]) > 1:
+        proportions = code_table_combined["Proportion of Codes (%)"].astype(object)
+        proportions[proportions == 0] = "< 0.005"
+        proportions[proportions == 100] = "> 99.995"
+        code_table_combined["Proportion of Codes (%)"] = proportions
+
+    code_table_combined.to_csv(output_dir / f"code_table_{measure}.csv")
+
+
+def combine_percentiles(measure, input_dir, backends, output_dir):
+    """Combines the sketches of the practice rates of a measure into percentiles.
+
+    Args:
+        measure: The measure ID.
+        input_dir: The directory containing a directory for each backend.
+        backends: The names of the backends.
+        output_dir: The directory to write the sketches and percentiles to.
+    """
+    # merge the sketches of the practice rates, rather than the rates themselves
+    sketches = merge_sketches(
+        *(
+            load_sketches(input_dir / backend / f"sketch_{measure}.json")
+            for backend in backends
+        )
+    )
+    save_sketches(sketches, output_dir / f"sketch_{measure}.json")
+    get_sketch_deciles(sketches).to_csv(
+        output_dir / f"percentiles_{measure}.csv", index=False
+    )
 
-    measure_path_emis = BASE_DIR / f"backend_outputs/emis/measure_cleaned_{measure}.csv"
-    measure_path_tpp = BASE_DIR / f"backend_outputs/tpp/measure_cleaned_{measure}.csv"
 
-    measure_emis = pd.read_csv(measure_path_emis)
-    measure_tpp = pd.read_csv(measure_path_tpp)
+def combine_measure(measure, input_dir, backends, output_dir, policy):
+    combine_code_table(measure, input_dir, backends, output_dir, policy)
+    combine_percentiles(measure, input_dir, backends, output_dir)
 
-    measures_combined = pd.concat([measure_emis, measure_tpp], axis="index")
-    measures_combined.to_csv(BASE_DIR / f"backend_outputs/measure_{measure}.csv")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backend",
+        action="append",
+        dest="backends",
+        help="a backend's directory within --input-dir (default: emis and tpp)",
+    )
+    parser.add_argument("--input-dir", type=Path, default=BASE_DIR / "backend_outputs")
+    parser.add_argument("--output-dir", type=Path, default=BASE_DIR / "backend_outputs")
+    parser.add_argument("--max-workers", type=int, default=4)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backends = args.backends or ["emis", "tpp"]
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    policy = Policy(threshold=10, base=5)
+
+    combine_demographics(args.input_dir, backends, args.output_dir, policy)
+
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        # consume the results, so that errors are raised
+        list(
+            executor.map(
+                lambda measure: combine_measure(
+                    measure, args.input_dir, backends, args.output_dir, policy
+                ),
+                sentinel_measures,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
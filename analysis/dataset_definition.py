@@ -1,16 +1,18 @@
+import argparse
+import csv
 from datetime import datetime
 
-from ehrql import Dataset, INTERVAL, Measures, case, months, when
+from ehrql import INTERVAL, Dataset, Measures, months
 from ehrql.codes import codelist_from_csv
-from ehrql.tables.beta.core import patients, clinical_events
-from ehrql.tables.beta.tpp import addresses, practice_registrations
+from ehrql.tables.beta.core import clinical_events, patients
+from ehrql.tables.beta.tpp import practice_registrations
 
 codelists = {
     "asthma": codelist_from_csv(
         "codelists/opensafely-asthma-annual-review-qof.csv", column="code"
     ),
     "copd": codelist_from_csv(
-        "codelists/opensafely-chronic-obstructive-pulmonary-disease-copd-review-qof.csv",
+        "codelists/opensafely-chronic-obstructive-pulmonary-disease-copd-review-qof.csv",  # noqa: E501
         column="code",
     ),
     "qrisk": codelist_from_csv(
@@ -44,7 +46,7 @@ codelists = {
         category_column="grouping_16_id",
     ),
     "medication_review_1": codelist_from_csv(
-        "codelists/opensafely-care-planning-medication-review-simple-reference-set-nhs-digital.csv",
+        "codelists/opensafely-care-planning-medication-review-simple-reference-set-nhs-digital.csv",  # noqa: E501
         column="code",
     ),
     "medication_review_2": codelist_from_csv(
@@ -129,11 +131,13 @@ measures.define_defaults(
 
 def calculate_num_intervals(start_date):
     """
-    Calculate the number of intervals between the start date and the start of the latest full month
+    Calculate the number of intervals between the start date and the start of the
+    latest full month
     Args:
         start_date: the start date of the study period
     Returns:
-        num_intervals (int): the number of intervals between the start date and the start of the latest full month
+        num_intervals (int): the number of intervals between the start date and the
+        start of the latest full month
     """
     now = datetime.now()
     start_of_latest_full_month = datetime(now.year, now.month, 1)
@@ -148,7 +152,44 @@ def calculate_num_intervals(start_date):
     return num_intervals
 
 
+def get_incremental_start_date(previous_measures, start_date):
+    """
+    Get the start date of the first interval that isn't in a previous measures file
+    Args:
+        previous_measures: the path to a measures file from an earlier run
+        start_date: the start date of the study period
+    Returns:
+        start_date (str): the start date of the first interval after those in the
+        previous measures file. If there is no full month after them, the start date
+        of the latest interval in the file, so that at least one interval is computed.
+    """
+    with open(previous_measures, newline="") as f:
+        latest_interval_start = max(
+            (row["interval_start"] for row in csv.DictReader(f)), default=None
+        )
+
+    if latest_interval_start is None:
+        return start_date
+
+    latest = datetime.strptime(latest_interval_start, "%Y-%m-%d")
+    next_interval_start = datetime(
+        latest.year + latest.month // 12, latest.month % 12 + 1, 1
+    ).strftime("%Y-%m-%d")
+
+    if calculate_num_intervals(next_interval_start) < 1:
+        return latest_interval_start
+    return next_interval_start
+
+
+# Pass `-- --since output/measures.csv` to only compute the intervals that come
+# after those in an earlier run, as analysis/update_measures.py describes
+parser = argparse.ArgumentParser()
+parser.add_argument("--since", help="a measures file from an earlier run")
+args, _ = parser.parse_known_args()
+
 start_date = "2019-01-01"
+if args.since:
+    start_date = get_incremental_start_date(args.since, start_date)
 num_intervals = calculate_num_intervals(start_date)
 
 
@@ -0,0 +1,141 @@
+"""Statistical disclosure control for the tables we release.
+
+Every output path applies a `Policy` with `apply_policy`, so that small numbers are
+suppressed and counts are rounded in the same way wherever they are released.
+"""
+import numpy as np
+import pandas as pd
+
+
+class Policy:
+    """A disclosure control policy.
+
+    Args:
+        threshold: Counts at or below this are suppressed.
+        base: Counts are rounded to the nearest multiple of this. If None, counts
+            aren't rounded.
+        secondary: Whether to suppress further counts within a group, when the
+            suppressed counts of the group sum to at or below `threshold`. If so,
+            nothing is suppressed in a group whose small counts are all zero.
+    """
+
+    def __init__(self, threshold=10, base=5, secondary=False):
+        self.threshold = threshold
+        self.base = base
+        self.secondary = secondary
+
+    def __repr__(self):
+        return (
+            f"Policy(threshold={self.threshold!r}, base={self.base!r}, "
+            f"secondary={self.secondary!r})"
+        )
+
+
+def get_redaction_mask(values, groups, n):
+    """Gets the cells to redact so that no group has a redacted total of <=n.
+
+    Within each group, every value <=n is redacted. If the redacted values sum to
+    more than zero, the smallest remaining values are then also redacted, in
+    order, until the redacted total is >n. Each group is sorted once and the
+    cut-off is found with a cumulative sum.
+
+    Args:
+        values: The values to redact.
+        groups: Integer group codes, one per value, in the range [0, n_groups).
+        n: Threshold for low number suppression.
+
+    Returns:
+        A boolean array that is True for the values to redact.
+    """
+    values = np.asarray(values, dtype=float)
+    groups = np.asarray(groups)
+
+    is_small = values <= n
+    small_total = np.bincount(groups, weights=np.where(is_small, values, 0))
+    # if the small values sum to zero we don't need to suppress anything
+    needs_suppression = small_total != 0
+    mask = is_small & needs_suppression[groups]
+
+    # remaining values, sorted by group and then by value (stable, so ties are
+    # redacted in their original order)
+    order = np.lexsort((values, groups))
+    order = order[~is_small[order] & ~np.isnan(values[order])]
+    order_values = values[order]
+    order_groups = groups[order]
+
+    # total redacted before each remaining value is considered
+    redacted_before = (
+        pd.Series(order_values).groupby(order_groups).cumsum().to_numpy()
+        - order_values
+        + small_total[order_groups]
+    )
+    is_secondary = needs_suppression[order_groups] & (redacted_before <= n)
+    mask[order[is_secondary]] = True
+    return mask
+
+
+def round_to_base(values, base=5):
+    """Rounds values to the nearest multiple of `base`, leaving NaNs as they are.
+
+    Halves are rounded to even multiples, as Python's `round` does.
+
+    Args:
+        values: A scalar, array, or Series.
+        base: The base to round to.
+
+    Returns:
+        The rounded values, of the same type as `values`.
+    """
+    return base * np.round(values / base)
+
+
+def get_suppression_mask(values, policy, groups=None):
+    """Gets the values to suppress under the given policy.
+
+    Args:
+        values: The values to suppress.
+        policy: A `Policy`.
+        groups: Integer group codes, one per value, for secondary suppression. If
+            None, all values are in the same group.
+
+    Returns:
+        A boolean array that is True for the values to suppress.
+    """
+    values = np.asarray(values, dtype=float)
+    if not policy.secondary:
+        return values <= policy.threshold
+    if groups is None:
+        groups = np.zeros(len(values), dtype=int)
+    return get_redaction_mask(values, groups, policy.threshold)
+
+
+def apply_policy(df, policy, columns=None, groups=None):
+    """Applies a disclosure control policy to a Series, or to columns of a DataFrame.
+
+    Values are suppressed (set to NaN) and then rounded. Each column is suppressed
+    independently.
+
+    Args:
+        df: A Series or DataFrame of counts.
+        policy: A `Policy`.
+        columns: The columns of a DataFrame to apply the policy to. Defaults to all
+            columns.
+        groups: Integer group codes, one per row, for secondary suppression.
+
+    Returns:
+        A copy of `df` with the policy applied.
+    """
+    if isinstance(df, pd.Series):
+        return _apply_policy(df, policy, groups)
+
+    df = df.copy()
+    for column in df.columns if columns is None else columns:
+        df[column] = _apply_policy(df[column], policy, groups)
+    return df
+
+
+def _apply_policy(values, policy, groups):
+    values = values.mask(get_suppression_mask(values, policy, groups))
+    if policy.base is not None:
+        values = round_to_base(values, policy.base)
+    return values
@@ -1,16 +1,39 @@
-import pandas as pd
+"""Joins the ethnicity extract onto each monthly extract.
+
+The ethnicity extract is sorted by patient ID once, and its columns are appended to
+each monthly extract as Arrow columns; the monthly extracts aren't converted to
+pandas. Months are joined in parallel, largest first.
+"""
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow.feather as feather
+from catalogue import get_extracts
+from utilities import OUTPUT_DIR, append_lookup_columns, sort_lookup_table
+
+MAX_WORKERS = 4
+
+# the ethnicity extract is read by name, so the directory isn't catalogued twice
+ethnicity = sort_lookup_table(
+    feather.read_table(OUTPUT_DIR / "input_ethnicity.feather")
+)
+
 
+def join_ethnicity(file):
+    table = append_lookup_columns(feather.read_table(file), ethnicity)
 
-ethnicity_df = pd.read_feather('output/input_ethnicity.feather')
+    # write alongside the extract, then replace it, so a failed write doesn't leave
+    # a truncated extract
+    tmp_file = file.with_name(f"{file.name}.tmp")
+    feather.write_feather(table, tmp_file)
+    os.replace(tmp_file, file)
 
 
-for file in os.listdir('output'):
-    if file.startswith('input'):
-        #exclude ethnicity
-        if file.split('_')[1] not in ['ethnicity.csv', 'practice']:
-            file_path = os.path.join('output', file)
-            df = pd.read_feather(file_path)
-            merged_df = df.merge(ethnicity_df, how='left', on='patient_id')
-            
-            merged_df.to_feather(file_path)
\ No newline at end of file
+# only the monthly extracts are joined, so the ethnicity extract is excluded. The
+# largest are started first, so that a large month isn't left until last
+extracts = sorted(
+    get_extracts(OUTPUT_DIR, "monthly"), key=lambda e: e["num_rows"], reverse=True
+)
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    for _ in executor.map(join_ethnicity, [e["path"] for e in extracts]):
+        pass
@@ -1,52 +1,75 @@
-import pandas as pd
-from pathlib import Path
+from functools import reduce
+
+import numpy as np
+from catalogue import get_extracts
 from utilities import (
-    get_patients_left_tpp,
-    get_patients_joined_tpp,
-    concatenate_patients_moved,
-    match_input_files,
-    get_date_input_file,
+    OUTPUT_DIR,
+    LatestRows,
+    PatientPresence,
+    count_patients_moved,
+    read_input_files,
     save_dict_as_json,
 )
 
-# this will contain dataframes of patients who have joined or left during the study period. There will be duplicates
-moved = []
+demographics = ["sex", "age_band", "ethnicity_x", "imd", "region"]
+columns = ["patient_id", "age", "age_start"] + demographics
+
+# 2019-01-01 is the month every other month is compared to
+first_month_date = "2019-01-01"
+
+presence = PatientPresence()
 
-first_month = pd.read_feather("output/joined/input_population_2019-01-01.feather")
+# patients who have joined or left during the study period. Only the most recent
+# demographics of each patient are kept
+moved = LatestRows("patient_id")
 
-for file in Path("output/joined").iterdir():
+extracts = get_extracts(OUTPUT_DIR / "joined", "population")
+dates = {e["path"]: e["date"] for e in extracts}
 
-    if match_input_files(file.name):
-        
-        df = pd.read_feather(file)
-        date = get_date_input_file(str(file.name))
+for file, df in read_input_files(columns=columns, files=list(dates)):
 
-        # 2019-01-01 is the month being compared, so we ignore it here
-        if date != "2019-01-01":
+    date = dates[file]
+    presence.add_month(date, df["patient_id"])
 
-            demographics_patients_left = get_patients_left_tpp(
-                df,
-                first_month,
-                ["sex", "age_band", "ethnicity_x", "imd", "region"],
-            )
+    if date == first_month_date:
+        first_month = df
+        continue
 
-            demographics_patients_joined = get_patients_joined_tpp(
-                df,
-                first_month,
-                "age",
-                "age_start",
-                ["sex", "age_band", "ethnicity_x", "imd", "region"],
-            )
-            demographics_patients_left["ethnicity_x"] = demographics_patients_left[
-                "ethnicity_x"
-            ].astype(str)
-            demographics_patients_joined["ethnicity_x"] = demographics_patients_joined[
-                "ethnicity_x"
-            ].astype(str)
-            moved.extend([demographics_patients_left, demographics_patients_joined])
+    # any patients in monthly cohort who weren't in the first month, and didn't
+    # become eligible by turning 18 in study
+    is_joined = (
+        ~presence.is_present(first_month_date, df["patient_id"])
+        & ~(df["age_start"] <= 17).to_numpy()
+    )
+    joined = df.loc[is_joined, ["patient_id"] + demographics]
+
+    # Anyone who has joined should now be counted as TPP
+    joined["ehr_provider"] = "TPP"
+    joined["ethnicity_x"] = joined["ethnicity_x"].astype(str)
+    moved.push(joined)
+
+# anyone in the first month but not in a later monthly cohort of people
+left_bits = reduce(
+    np.bitwise_or,
+    (
+        presence.get_left(date, first_month_date)
+        for date in presence.months
+        if date != first_month_date
+    ),
+    np.zeros_like(presence.get_month(first_month_date)),
+)
+left = first_month.loc[
+    first_month["patient_id"].isin(presence.to_patient_ids(left_bits)),
+    ["patient_id"] + demographics,
+]
 
+# lets assume the people who leave go to EMIS
+left["ehr_provider"] = "EMIS"
+left["ethnicity_x"] = left["ethnicity_x"].astype(str)
+moved.push(left)
 
-total_moved, dem_counts = concatenate_patients_moved(moved)
+with moved:
+    total_moved, dem_counts = count_patients_moved(moved)
 
 save_dict_as_json(total_moved, "output/moved_count.json")
 save_dict_as_json(dem_counts, "output/moved_demographic_count.json")
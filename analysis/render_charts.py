@@ -0,0 +1,109 @@
+"""Renders the decile chart of every measure in an ehrQL measures file.
+
+Charts are rendered with a non-interactive backend, so no notebook kernel is
+needed, and measures can be rendered in parallel. The measures file is first split
+into a file per measure, so each process reads only its own measure. For example:
+
+    python analysis/render_charts.py --input output/measures.csv --processes 4
+"""
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt  # noqa: E402
+from charts import deciles_chart_ebm  # noqa: E402
+from utilities import (  # noqa: E402
+    OUTPUT_DIR,
+    drop_irrelevant_practices,
+    read_split_measure,
+    split_measures_csv,
+)
+
+
+def render_chart(measure, measure_path, output_dir, formats, width, height):
+    """Renders the decile chart for the given measure, then closes it.
+
+    Args:
+        measure: The measure ID, e.g. "asthma".
+        measure_path: The path to the practice-level ehrQL measure table for the
+            measure, as written by `split_measures_csv`.
+        output_dir: The directory to save the chart to.
+        formats: The file formats to save the chart as, e.g. ["png", "svg"].
+        width: The width of the chart, in pixels.
+        height: The height of the chart, in pixels.
+
+    Returns:
+        A list of paths to the saved charts.
+    """
+    measure_table = read_split_measure(measure_path)
+    measure_table = drop_irrelevant_practices(measure_table, "ratio")
+    measure_table["rate_per_1000"] = measure_table["ratio"] * 1000
+
+    px = 1 / plt.rcParams["figure.dpi"]  # pixel in inches
+    fig, ax = plt.subplots(1, 1, figsize=(width * px, height * px), tight_layout=True)
+    deciles_chart_ebm(
+        measure_table,
+        period_column="interval_start",
+        column="rate_per_1000",
+        ylabel="rate per 1000",
+        show_outer_percentiles=True,
+        ax=ax,
+        show=False,
+    )
+
+    paths = []
+    for f in formats:
+        path = Path(output_dir) / f"deciles_chart_{measure}.{f}"
+        fig.savefig(path, bbox_inches="tight")
+        paths.append(path)
+    plt.close(fig)
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--input", type=Path, default=OUTPUT_DIR / "measures.csv")
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR / "charts")
+    parser.add_argument("--format", nargs="+", default=["png"], dest="formats")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--width", type=int, default=1000)
+    parser.add_argument("--height", type=int, default=600)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as split_dir:
+        measure_paths = {
+            name[: -len("_practice")]: path
+            for name, path in split_measures_csv(args.input, split_dir).items()
+            if name.endswith("_practice")
+        }
+
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [
+                executor.submit(
+                    render_chart,
+                    measure,
+                    measure_path,
+                    args.output_dir,
+                    args.formats,
+                    args.width,
+                    args.height,
+                )
+                for measure, measure_path in measure_paths.items()
+            ]
+            for future in futures:
+                for path in future.result():
+                    print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Mergeable quantile sketches, so that backends can share percentiles, not rows.
+
+A `KLLSketch` summarises a stream of values in a bounded number of items (about
+`3 * k`), from which quantiles can be estimated. Sketches of the same measure and
+month from different backends can be merged, and the merged sketch is as accurate
+as a sketch of all of their values.
+
+While a sketch holds fewer than about `k` values, it holds all of them and its
+quantiles are exact: they are linearly interpolated between the closest ranks, as
+pandas does. After that, the rank of each estimated quantile is within
+`get_rank_error(k) * n` of the true rank, with 99% confidence, where `n` is the
+number of values. For the default `k=200`, that is 1.3% of `n`.
+
+Each backend writes the sketches of a measure, one per month, with
+`save_sketches`; `combine_backends.py` merges them with `merge_sketches`. As a
+sketch may hold every value it was given, only values that may be released as
+they are should be sketched.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+from utilities import get_quantiles
+
+# the capacity of each level of a sketch, relative to the level above it
+CAPACITY_RATIO = 2 / 3
+
+
+def get_rank_error(k):
+    """Gets the normalised rank error of a sketch, with 99% confidence.
+
+    This is the empirical bound of the KLL sketch of Apache DataSketches, on which
+    `KLLSketch` is modelled.
+
+    Args:
+        k: The accuracy parameter of the sketch.
+
+    Returns:
+        The error, as a fraction of the number of values.
+    """
+    return 2.296 / k ** 0.9723
+
+
+class KLLSketch:
+    """A KLL quantile sketch, as described by Karnin, Lang and Liberty (2016).
+
+    Values are kept in levels of compactors: an item at level h stands for 2**h
+    values. When a level is over its capacity, it is sorted and every other item,
+    starting from a random offset, is promoted to the level above it.
+
+    Args:
+        k: The accuracy parameter. Larger values are more accurate and larger.
+        seed: The seed of the random offsets, so that sketches are reproducible.
+    """
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+    def __repr__(self):
+        return f"KLLSketch(k={self.k!r}, n={self.n!r}, items={len(self)!r})"
+
+    def get_capacity(self, level):
+        num_levels = len(self.levels)
+        return max(2, int(np.ceil(self.k * CAPACITY_RATIO ** (num_levels - level - 1))))
+
+    def update(self, values):
+        """Adds values to the sketch, ignoring missing and infinite values.
+
+        Args:
+            values: An array or Series of values.
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Merges another sketch into this one.
+
+        Args:
+            other: A `KLLSketch` with the same `k`.
+        """
+        if other.k != self.k:
+            raise ValueError(f"Can't merge sketches with k={self.k} and k={other.k}")
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def _compress(self):
+        while len(self) > sum(self.get_capacity(h) for h in range(len(self.levels))):
+            # compact the lowest level that is over its capacity
+            h = next(
+                h
+                for h in range(len(self.levels))
+                if len(self.levels[h]) >= self.get_capacity(h)
+            )
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            level = np.sort(self.levels[h])
+            # an odd item out stays at this level
+            kept, level = level[: len(level) % 2], level[len(level) % 2 :]
+            promoted = level[self._rng.integers(2) :: 2]
+            self.levels[h] = kept
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+
+    def get_weighted_items(self):
+        """Gets the items of the sketch, sorted, with the number of values of each."""
+        items = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)]
+        )
+        order = np.argsort(items, kind="stable")
+        return items[order], weights[order]
+
+    def quantiles(self, quantiles):
+        """Estimates quantiles of the values added to the sketch.
+
+        Each item is placed at the middle of the ranks of the values it stands for,
+        and quantiles are linearly interpolated between items, as pandas does
+        between values.
+
+        Args:
+            quantiles: An array of quantiles, between 0 and 1.
+
+        Returns:
+            An array of estimates, which are NaN if the sketch is empty.
+        """
+        quantiles = np.asarray(quantiles, dtype=float)
+        if self.n == 0:
+            return np.full(quantiles.shape, np.nan)
+        items, weights = self.get_weighted_items()
+        ranks = np.cumsum(weights) - (weights + 1) / 2
+        return np.interp(quantiles * (self.n - 1), ranks, items)
+
+    def to_dict(self):
+        """Gets a dict of the sketch that can be saved as JSON."""
+        return {
+            "k": self.k,
+            "n": self.n,
+            "levels": [level.tolist() for level in self.levels],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Makes a sketch from a dict returned by `to_dict`."""
+        sketch = cls(k=d["k"])
+        sketch.n = d["n"]
+        sketch.levels = [np.asarray(level, dtype=float) for level in d["levels"]]
+        return sketch
+
+
+def sketch_by_date(measure_table, date_col, values_col, k=200):
+    """Sketches the values of a measure table, for each date.
+
+    Args:
+        measure_table: A measure table.
+        date_col: The name of the date column.
+        values_col: The name of the column to sketch.
+        k: The accuracy parameter of the sketches.
+
+    Returns:
+        A dict of dates, in the format YYYY-MM-DD, to sketches.
+    """
+    dates = pd.to_datetime(measure_table[date_col]).dt.strftime("%Y-%m-%d")
+    return {
+        date: KLLSketch(k=k).update(values)
+        for date, values in measure_table[values_col].groupby(dates, sort=True)
+    }
+
+
+def merge_sketches(*sketches_by_date):
+    """Merges sketches by date.
+
+    Args:
+        *sketches_by_date: Dicts of dates to sketches, e.g. one for each backend.
+
+    Returns:
+        A dict of dates to merged sketches. The sketches of the first dict are merged
+        into, so aren't reused.
+    """
+    merged = {}
+    for sketches in sketches_by_date:
+        for date, sketch in sketches.items():
+            if date in merged:
+                merged[date].merge(sketch)
+            else:
+                merged[date] = sketch
+    return dict(sorted(merged.items()))
+
+
+def get_sketch_deciles(
+    sketches, date_col="date", values_col="rate", has_outer_percentiles=True
+):
+    """Estimates the deciles of each date from its sketch.
+
+    Args:
+        sketches: A dict of dates to sketches.
+        date_col: The name of the date column.
+        values_col: The name of the values column.
+        has_outer_percentiles: Whether to estimate the nine largest and nine smallest
+            percentiles as well as the deciles.
+
+    Returns:
+        A data frame with `date_col`, `percentile`, and `values_col` columns, like the
+        one returned by `utilities.compute_deciles`.
+    """
+    quantiles = get_quantiles(has_outer_percentiles)
+    dates = list(sketches)
+    values = [sketches[date].quantiles(quantiles) for date in dates]
+    return pd.DataFrame(
+        {
+            date_col: pd.to_datetime(np.repeat(dates, len(quantiles))),
+            "percentile": np.tile(np.rint(quantiles * 100).astype(int), len(dates)),
+            values_col: np.concatenate(values) if values else np.empty(0),
+        }
+    )
+
+
+def save_sketches(sketches, output_path):
+    """Saves a dict of dates to sketches as JSON."""
+    with open(output_path, "w") as f:
+        json.dump({date: s.to_dict() for date, s in sketches.items()}, f)
+
+
+def load_sketches(input_path):
+    """Loads a dict of dates to sketches saved by `save_sketches`."""
+    with open(input_path) as f:
+        return {date: KLLSketch.from_dict(d) for date, d in json.load(f).items()}
@@ -0,0 +1,66 @@
+"""Summarises the monthly extracts in a single pass.
+
+Each extract is read once, to count the practices, the patients with an event for
+each measure, and the events for each measure. The summary of each extract is saved
+to `output/extract_summaries`, so that the summaries can be merged without reading
+the extracts again, and is merged into a running summary of all of the extracts.
+"""
+import json
+
+from catalogue import get_extracts
+from utilities import (
+    OUTPUT_DIR,
+    merge_extract_summaries,
+    read_input_files,
+    save_extract_summary,
+    summarise_extract,
+)
+
+sentinel_measures = [
+    "qrisk2",
+    "asthma",
+    "copd",
+    "sodium",
+    "cholesterol",
+    "alt",
+    "tsh",
+    "rbc",
+    "hba1c",
+    "systolic_bp",
+    "medication_review",
+]
+
+summaries_dir = OUTPUT_DIR / "extract_summaries"
+summaries_dir.mkdir(exist_ok=True)
+
+files = [extract["path"] for extract in get_extracts(OUTPUT_DIR, "monthly")]
+
+# only read the columns we need, rather than the whole extract. Each extract's
+# summary is merged as it's made, so only the running summary is kept in memory
+summaries = []
+for file, df in read_input_files(
+    columns=["patient_id", "practice"] + sentinel_measures, files=files
+):
+    extract_summary = summarise_extract(df, sentinel_measures)
+    save_extract_summary(extract_summary, summaries_dir / f"{file.stem}.npz")
+    summaries = [merge_extract_summaries(summaries + [extract_summary])]
+
+summary = merge_extract_summaries(summaries)
+
+with open(OUTPUT_DIR / "practice_count.json", "w") as f:
+    json.dump({"num_practices": len(summary["practices"])}, f)
+
+with open(OUTPUT_DIR / "patient_count.json", "w") as f:
+    # number of unique patients as num(mil)
+    json.dump(
+        {
+            "num_patients": {
+                m: len(patients) / 1000000
+                for m, patients in summary["patients"].items()
+            }
+        },
+        f,
+    )
+
+with open(OUTPUT_DIR / "extract_event_count.json", "w") as f:
+    json.dump({"num_events": summary["events"]}, f)
@@ -0,0 +1,141 @@
+"""Appends the latest ehrQL measures to earlier results, with their summaries.
+
+Only the new intervals are summarised: the percentiles of practice-level measures
+and the event counts of code-level measures for earlier intervals are read from
+`--previous-summaries`, when given, rather than computed again.
+
+Without `--previous-measures`, the latest measures are summarised from scratch.
+Measures that are in the previous measures but not in the latest measures are
+written unchanged, with their summaries.
+Practices are dropped as irrelevant based on all intervals, but the percentiles of
+earlier intervals are kept as they were computed.
+
+The output directory can be the directory of the previous measures and summaries,
+so that each refresh starts from the results of the one before it. For example,
+to summarise a full run once:
+
+    python analysis/update_measures.py \
+        --latest-measures output/measures.csv \
+        --output-dir output/updated
+
+and then, each month, to compute and append only the new intervals:
+
+    ehrql generate-measures analysis/dataset_definition.py \
+        --output output/latest/measures.csv -- --since output/updated/measures.csv
+    python analysis/update_measures.py \
+        --previous-measures output/updated/measures.csv \
+        --latest-measures output/latest/measures.csv \
+        --previous-summaries output/updated \
+        --output-dir output/updated
+
+This isn't an action in project.yaml, because an action can't read its own
+outputs from an earlier run.
+"""
+import argparse
+from pathlib import Path
+
+import pandas as pd
+from utilities import (
+    append_new_intervals,
+    drop_irrelevant_practices,
+    read_measures_csv,
+    update_deciles,
+)
+
+
+def read_summary(previous_summaries, f_name):
+    """Reads a summary from an earlier run, if there is one."""
+    if previous_summaries is None:
+        return None
+    f_in = previous_summaries / f_name
+    if not f_in.exists():
+        return None
+    return pd.read_csv(f_in, parse_dates=["interval_start"])
+
+
+def update_percentiles(measure_table, percentiles):
+    measure_table = drop_irrelevant_practices(measure_table, "ratio")
+    measure_table["rate_per_1000"] = measure_table["ratio"] * 1000
+    return update_deciles(percentiles, measure_table, "interval_start", "rate_per_1000")
+
+
+def update_code_counts(measure_table, code_column, code_counts):
+    if code_counts is not None:
+        measure_table = measure_table[
+            ~measure_table["interval_start"].isin(code_counts["interval_start"])
+        ]
+    new_code_counts = (
+        measure_table.groupby(["interval_start", code_column])["numerator"]
+        .sum()
+        .rename("events")
+        .reset_index()
+        .rename(columns={code_column: "code"})
+    )
+    return pd.concat([code_counts, new_code_counts], ignore_index=True)
+
+
+def merge_measure_tables(previous_tables, latest_tables):
+    """Appends the new intervals of each measure to its earlier results.
+
+    Measures that are only in the earlier results are kept unchanged, and measures
+    that are only in the latest results are added.
+
+    Args:
+        previous_tables: A dict of measure names to measure tables from an earlier
+            run.
+        latest_tables: A dict of measure names to measure tables from a later run.
+
+    Returns:
+        A dict of measure names to measure tables.
+    """
+    measure_tables = {
+        name: append_new_intervals(df, latest_tables[name])
+        if name in latest_tables
+        else df
+        for name, df in previous_tables.items()
+    }
+    for name, df in latest_tables.items():
+        if name not in measure_tables:
+            measure_tables[name] = df
+    return measure_tables
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--previous-measures", type=Path)
+    parser.add_argument("--latest-measures", type=Path, required=True)
+    parser.add_argument("--previous-summaries", type=Path)
+    parser.add_argument("--output-dir", type=Path, required=True)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    measure_tables = read_measures_csv(args.latest_measures)
+    if args.previous_measures:
+        measure_tables = merge_measure_tables(
+            read_measures_csv(args.previous_measures), measure_tables
+        )
+
+    for name, df in measure_tables.items():
+        if name.endswith("_practice"):
+            f_name = f"percentiles_{name[: -len('_practice')]}.csv"
+            percentiles = read_summary(args.previous_summaries, f_name)
+            percentiles = update_percentiles(df, percentiles)
+            percentiles.to_csv(args.output_dir / f_name, index=False)
+
+        elif name.endswith("_code"):
+            f_name = f"code_counts_{name[: -len('_code')]}.csv"
+            code_counts = read_summary(args.previous_summaries, f_name)
+            code_counts = update_code_counts(df, name, code_counts)
+            code_counts.to_csv(args.output_dir / f_name, index=False)
+
+    pd.concat(measure_tables.values(), ignore_index=True).to_csv(
+        args.output_dir / "measures.csv", index=False
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,73 @@
+import hashlib
+import importlib
 import json
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import re
-import matplotlib
-import matplotlib.pyplot as plt
+
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-import seaborn as sns
-from IPython.display import HTML, display, Markdown
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+from catalogue import PREFIXES, get_extracts, parse_extract_name
+from disclosure import Policy, apply_policy, round_to_base
+from pandas.api.types import is_datetime64_any_dtype, is_extension_array_dtype
 
 BASE_DIR = Path(__file__).parents[1]
 OUTPUT_DIR = BASE_DIR / "output"
 
-
-# Legend locations for matplotlib
-# https://github.com/ebmdatalab/datalab-pandas/blob/master/ebmdatalab/charts.py
-BEST = 0
-UPPER_RIGHT = 1
-UPPER_LEFT = 2
-LOWER_LEFT = 3
-LOWER_RIGHT = 4
-RIGHT = 5
-CENTER_LEFT = 6
-CENTER_RIGHT = 7
-LOWER_CENTER = 8
-UPPER_CENTER = 9
-CENTER = 10
-
-BASE_DIR = Path(__file__).parents[1]
-OUTPUT_DIR = BASE_DIR / "output"
+# Names that are defined in `charts`, which is only imported when one of them is
+# used, so that scripts that don't draw charts don't import the plotting libraries
+CHART_NAMES = [
+    "BEST",
+    "UPPER_RIGHT",
+    "UPPER_LEFT",
+    "LOWER_LEFT",
+    "LOWER_RIGHT",
+    "RIGHT",
+    "CENTER_LEFT",
+    "CENTER_RIGHT",
+    "LOWER_CENTER",
+    "UPPER_CENTER",
+    "CENTER",
+    "deciles_chart_ebm",
+    "deciles_chart",
+    "generate_sentinel_measure",
+    "display_plotlyjs",
+    "classify_changes",
+    "display_changes",
+    # the notebooks use these after `from utilities import *`
+    "matplotlib",
+    "plt",
+    "go",
+    "sns",
+    "HTML",
+    "display",
+    "Markdown",
+]
+
+
+def __getattr__(name):
+    if name in CHART_NAMES:
+        return getattr(importlib.import_module("charts"), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Percentile tables computed by `get_deciles`, keyed on a hash of the measure
+# table's contents and the quantile set. Only the most recently used tables are
+# kept, so the cache doesn't grow with every measure drawn in a notebook.
+DECILES_CACHE = OrderedDict()
+DECILES_CACHE_SIZE = 4
 
 
 def load_and_drop(measure, practice=False):
     """Loads the measure table for the measure with the given ID.
 
-    Drops irrelevant practices and produces stripped measures
+    Drops irrelevant practices and produces stripped measures. The table is read
+    from the measures cache if it is up to date, or if the CSV file has been
+    removed, and from the CSV file otherwise.
 
     Args:
         measure: The measure ID.
@@ -44,21 +77,334 @@ def load_and_drop(measure, practice=False):
         The table for the given measure ID and practice.
     """
     if practice:
-        f_in = OUTPUT_DIR / f"measure_{measure}_practice_only_rate.csv"
+        kind = "practice_only_rate"
     else:
-        f_in = OUTPUT_DIR / f"measure_{measure}_rate.csv"
-
-    df = pd.read_csv(f_in, parse_dates=["date"])
+        kind = "rate"
+    f_in = OUTPUT_DIR / f"measure_{measure}_{kind}.csv"
+
+    f_cache = get_measure_cache_path(measure, kind)
+    if f_cache.exists() and (
+        not f_in.exists() or f_cache.stat().st_mtime >= f_in.stat().st_mtime
+    ):
+        # drop irrelevant practices from the memory-mapped table, so that only
+        # the relevant rows are copied
+        table = open_measure_cache(measure, kind)
+        mask = get_relevant_practices_mask(
+            table.column("practice").to_numpy(),
+            table.column("value").to_numpy(),
+        )
+        df = table.filter(pa.array(mask)).to_pandas(
+            split_blocks=True, self_destruct=True
+        )
+        del table
+    else:
+        df = pd.read_csv(f_in, parse_dates=["date"])
+        df = drop_irrelevant_practices(df)
 
     if practice:
-        df = drop_irrelevant_practices(df)
-        df = produce_stripped_measures(df, measure)
+        df = produce_stripped_measures(df, measure, drop_irrelevant=False)
 
-    else:
+    return df
 
-        df = drop_irrelevant_practices(df)
 
-    return df
+def get_measure_cache_path(measure, kind, cache_dir=None):
+    """Gets the path to a measure table in the measures cache.
+
+    The cache is an Arrow dataset, partitioned by kind and then by measure.
+
+    Args:
+        measure: The measure ID.
+        kind: The kind of measure table, e.g. "rate" or "practice_only_rate".
+        cache_dir: The cache directory. Defaults to `OUTPUT_DIR / "measures_cache"`.
+    """
+    if cache_dir is None:
+        cache_dir = OUTPUT_DIR / "measures_cache"
+    return Path(cache_dir) / f"kind={kind}" / f"measure={measure}" / "part-0.feather"
+
+
+def write_measure_cache(df, measure, kind, cache_dir=None):
+    """Writes a measure table to the measures cache.
+
+    Tables are written uncompressed, so they can be memory-mapped when read.
+
+    Args:
+        df: A measure table, with date-typed date columns.
+        measure: The measure ID.
+        kind: The kind of measure table, e.g. "rate" or "practice_only_rate".
+        cache_dir: The cache directory. Defaults to `OUTPUT_DIR / "measures_cache"`.
+
+    Returns:
+        The path to the cached table.
+    """
+    f_out = get_measure_cache_path(measure, kind, cache_dir)
+    f_out.parent.mkdir(parents=True, exist_ok=True)
+    feather.write_feather(df.reset_index(drop=True), f_out, compression="uncompressed")
+    return f_out
+
+
+def open_measure_cache(measure, kind, cache_dir=None):
+    """Opens a measure table in the measures cache without reading it.
+
+    The table is memory-mapped, so its columns are only paged in when they are
+    used, and selecting rows from it doesn't copy the whole table.
+
+    Args:
+        measure: The measure ID.
+        kind: The kind of measure table, e.g. "rate" or "practice_only_rate".
+        cache_dir: The cache directory. Defaults to `OUTPUT_DIR / "measures_cache"`.
+
+    Returns:
+        A `pyarrow.Table`.
+    """
+    f_cache = get_measure_cache_path(measure, kind, cache_dir)
+    return pa.ipc.open_file(pa.memory_map(str(f_cache))).read_all()
+
+
+def read_measure_cache(measure, kind, columns=None, filter=None, cache_dir=None):
+    """Reads a measure table from the measures cache.
+
+    Only the partition for the given measure and kind is read, as each measure has
+    its own columns. Column selection and filters are pushed down to the reader.
+
+    Args:
+        measure: The measure ID.
+        kind: The kind of measure table, e.g. "rate" or "practice_only_rate".
+        columns: The columns to read. Defaults to all columns.
+        filter: A `pyarrow.dataset.Expression` that rows must satisfy, e.g.
+            `ds.field("date") >= pd.Timestamp("2020-01-01")`.
+        cache_dir: The cache directory. Defaults to `OUTPUT_DIR / "measures_cache"`.
+
+    Returns:
+        The measure table.
+    """
+    f_cache = get_measure_cache_path(measure, kind, cache_dir)
+    dataset = ds.dataset(f_cache.parent, format="ipc")
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+# Compact dtypes for the columns of an ehrQL measures file. Group-by columns,
+# such as `practice` and `<measure>_code`, are read as nullable integers.
+MEASURES_CSV_DTYPES = {
+    "measure": "category",
+    "numerator": "int32",
+    "denominator": "int32",
+    "ratio": "float32",
+}
+MEASURES_CSV_DATE_COLUMNS = ["interval_start", "interval_end"]
+
+
+def get_measures_csv_dtypes(f_in):
+    """Gets compact dtypes for the columns of an ehrQL measures file.
+
+    Args:
+        f_in: The path to the measures file.
+
+    Returns:
+        A tuple of a mapping of column names to dtypes and a list of the names of
+        the group-by columns, which are read as nullable integers.
+    """
+    columns = pd.read_csv(f_in, nrows=0).columns
+    group_by_columns = [
+        c
+        for c in columns
+        if c not in MEASURES_CSV_DTYPES and c not in MEASURES_CSV_DATE_COLUMNS
+    ]
+    dtype = {**MEASURES_CSV_DTYPES, **{c: "Int64" for c in group_by_columns}}
+    return dtype, group_by_columns
+
+
+def iter_measures_csv(f_in, measures=None, chunksize=1_000_000):
+    """Reads an ehrQL measures file in chunks, split by measure.
+
+    Args:
+        f_in: The path to the measures file.
+        measures: The names of the measures to read. Defaults to all measures.
+        chunksize: The number of rows to read at a time.
+
+    Yields:
+        Tuples of a measure name and the rows of a chunk for that measure.
+    """
+    dtype, _ = get_measures_csv_dtypes(f_in)
+    for chunk in pd.read_csv(
+        f_in,
+        dtype=dtype,
+        parse_dates=MEASURES_CSV_DATE_COLUMNS,
+        chunksize=chunksize,
+    ):
+        if measures is not None:
+            chunk = chunk[chunk["measure"].isin(measures)]
+        for measure, df in chunk.groupby("measure", observed=True):
+            yield measure, df
+
+
+def read_measures_csv(f_in, measures=None, chunksize=1_000_000):
+    """Reads an ehrQL measures file in chunks, with compact dtypes.
+
+    Group-by columns that are empty for a measure, such as the `<measure>_code`
+    columns of a practice-level measure, are dropped from its table.
+
+    Args:
+        f_in: The path to the measures file.
+        measures: The names of the measures to read. Defaults to all measures.
+        chunksize: The number of rows to read at a time.
+
+    Returns:
+        A mapping of measure names to measure tables.
+    """
+    _, group_by_columns = get_measures_csv_dtypes(f_in)
+    chunks = {}
+    for measure, df in iter_measures_csv(f_in, measures, chunksize):
+        chunks.setdefault(measure, []).append(df)
+
+    measure_tables = {}
+    for measure, dfs in chunks.items():
+        df = pd.concat(dfs, ignore_index=True)
+        df["measure"] = df["measure"].astype("category")
+        is_empty = df[group_by_columns].isna().all()
+        measure_tables[measure] = df.drop(columns=is_empty[is_empty].index)
+    return measure_tables
+
+
+def get_measures_arrow_schema(f_in):
+    """Gets an explicit Arrow schema for the columns of an ehrQL measures file.
+
+    The schema matches the dtypes of `get_measures_csv_dtypes`, so that every chunk
+    of the file is converted to the same types, whichever of its values are null.
+
+    Args:
+        f_in: The path to the measures file.
+
+    Returns:
+        A tuple of the schema and a list of the names of the group-by columns.
+    """
+    types = {
+        "measure": pa.string(),
+        "numerator": pa.int32(),
+        "denominator": pa.int32(),
+        "ratio": pa.float32(),
+    }
+    columns = pd.read_csv(f_in, nrows=0).columns
+    _, group_by_columns = get_measures_csv_dtypes(f_in)
+    fields = []
+    for c in columns:
+        if c in MEASURES_CSV_DATE_COLUMNS:
+            fields.append(pa.field(c, pa.timestamp("ns")))
+        elif c in group_by_columns:
+            fields.append(pa.field(c, pa.int64()))
+        else:
+            fields.append(pa.field(c, types[c]))
+    return pa.schema(fields), group_by_columns
+
+
+def split_measures_csv(f_in, output_dir, chunksize=1_000_000):
+    """Splits an ehrQL measures file into one Feather file per measure.
+
+    The file is read in chunks, and each chunk is appended to its measure's file,
+    so memory is bounded by the chunk size rather than by the whole file. Every
+    file has all of the columns of the measures file, with the types of
+    `get_measures_arrow_schema`; use `read_split_measure` to read one back.
+
+    Args:
+        f_in: The path to the measures file.
+        output_dir: The directory to write `measures_<measure>.feather` files to.
+        chunksize: The number of rows to read at a time.
+
+    Returns:
+        A mapping of measure names to the paths of their Feather files.
+    """
+    schema, _ = get_measures_arrow_schema(f_in)
+    paths = {}
+    writers = {}
+    try:
+        for measure, df in iter_measures_csv(f_in, chunksize=chunksize):
+            if measure not in writers:
+                paths[measure] = Path(output_dir) / f"measures_{measure}.feather"
+                writers[measure] = pa.ipc.new_file(str(paths[measure]), schema)
+            df = df.astype({"measure": str})
+            writers[measure].write_table(
+                pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            )
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths
+
+
+def read_split_measure(path):
+    """Reads a measure table written by `split_measures_csv`.
+
+    Group-by columns that are empty for the measure are dropped, as
+    `read_measures_csv` does.
+
+    Args:
+        path: The path to the measure's Feather file.
+
+    Returns:
+        The measure table.
+    """
+    df = feather.read_table(str(path)).to_pandas(
+        types_mapper={pa.int64(): pd.Int64Dtype()}.get
+    )
+    df["measure"] = df["measure"].astype("category")
+    group_by_columns = [
+        c
+        for c in df.columns
+        if c not in MEASURES_CSV_DTYPES and c not in MEASURES_CSV_DATE_COLUMNS
+    ]
+    is_empty = df[group_by_columns].isna().all()
+    return df.drop(columns=is_empty[is_empty].index)
+
+
+def append_new_intervals(previous, latest, interval_column="interval_start"):
+    """Appends the intervals of a measure table that aren't in an earlier one.
+
+    Args:
+        previous: A measure table from an earlier run.
+        latest: A measure table from a later run.
+        interval_column: The name of the column of interval start dates.
+
+    Returns:
+        A copy of `previous` with the rows for the new intervals of `latest`
+        appended.
+
+    Raises:
+        ValueError: If the new intervals don't follow on from the earlier ones.
+    """
+    new_rows = latest[~latest[interval_column].isin(previous[interval_column])]
+    if len(previous) and len(new_rows):
+        expected_start = previous[interval_column].max() + pd.DateOffset(months=1)
+        if new_rows[interval_column].min() != expected_start:
+            raise ValueError(
+                f"New intervals start on {new_rows[interval_column].min():%Y-%m-%d}, "
+                f"but should start on {expected_start:%Y-%m-%d}"
+            )
+    return pd.concat([previous, new_rows], ignore_index=True)
+
+
+def update_deciles(
+    percentiles, measure_table, groupby_col, values_col, has_outer_percentiles=True
+):
+    """Computes deciles for the groups that don't have them yet.
+
+    Args:
+        percentiles: A data frame returned by `compute_deciles`, or None.
+        measure_table: A measure table.
+        groupby_col: The name of the column to group by.
+        values_col: The name of the column for which deciles are computed.
+        has_outer_percentiles: Whether to compute the nine largest and nine smallest
+            percentiles as well as the deciles.
+
+    Returns:
+        A copy of `percentiles` with the percentiles of the new groups appended.
+    """
+    if percentiles is not None:
+        measure_table = measure_table[
+            ~measure_table[groupby_col].isin(percentiles[groupby_col])
+        ]
+    new_percentiles = compute_deciles(
+        measure_table, groupby_col, values_col, has_outer_percentiles
+    )
+    return pd.concat([percentiles, new_percentiles], ignore_index=True)
 
 
 def convert_ethnicity(df):
@@ -97,20 +443,43 @@ def calculate_rate(df, value_col, population_col, round_rate=False):
     df["rate"] = num_per_thousand
 
 
-def drop_irrelevant_practices(df):
+def drop_irrelevant_practices(df, value_col="value"):
     """Drops irrelevant practices from the given measure table.
 
     An irrelevant practice has zero events during the study period.
 
     Args:
         df: A measure table.
+        value_col: The name of the column that is zero when there are no events,
+            e.g. "ratio" for an ehrQL measure table.
 
     Returns:
         A copy of the given measure table with irrelevant practices dropped.
     """
+    practice = df["practice"]
+    if is_extension_array_dtype(practice) and not practice.hasnans:
+        # e.g. the nullable integers of an ehrQL measure table, which NumPy would
+        # otherwise compare as Python objects
+        practice = practice.to_numpy(dtype=np.int64)
+    return df[get_relevant_practices_mask(practice, df[value_col])]
+
+
+def get_relevant_practices_mask(practice, value):
+    """Gets a mask of the rows that belong to relevant practices.
+
+    A relevant practice has a non-zero value for at least one row.
+
+    Args:
+        practice: The practice ID of each row.
+        value: The value of each row.
 
-    is_relevant = df.groupby("practice").value.any()
-    return df[df.practice.isin(is_relevant[is_relevant == True].index)]
+    Returns:
+        A boolean array that is True for the rows of relevant practices.
+    """
+    practice = np.asarray(practice)
+    value = np.asarray(value, dtype=float)
+    relevant_practices = np.unique(practice[(value != 0) & ~np.isnan(value)])
+    return np.isin(practice, relevant_practices)
 
 
 def create_child_table(df, code_df, code_column, term_column, measure, nrows=5):
@@ -189,6 +558,119 @@ def create_child_table(df, code_df, code_column, term_column, measure, nrows=5):
     return event_counts.head(5), event_counts_with_count.head()
 
 
+SENTINEL_MEASURE_CODELISTS = {
+    "systolic_bp": ["opensafely-systolic-blood-pressure-qof"],
+    "qrisk2": ["opensafely-cvd-risk-assessment-score-qof"],
+    "cholesterol": ["opensafely-cholesterol-tests"],
+    "alt": ["opensafely-alanine-aminotransferase-alt-tests"],
+    "tsh": ["opensafely-thyroid-stimulating-hormone-tsh-testing"],
+    "rbc": ["opensafely-red-blood-cell-rbc-tests"],
+    "hba1c": ["opensafely-glycated-haemoglobin-hba1c-tests"],
+    "sodium": ["opensafely-sodium-tests-numerical-value"],
+    "asthma": ["opensafely-asthma-annual-review-qof"],
+    "copd": ["opensafely-chronic-obstructive-pulmonary-disease-copd-review-qof"],
+    "medication_review": [
+        "opensafely-care-planning-medication-review-simple-reference-set-nhs-digital",
+        "nhsd-primary-care-domain-refsets-medrvw_cod",
+    ],
+}
+
+
+def load_codelist_terms(measure):
+    """Loads the terms of the codes in the codelists of a sentinel measure.
+
+    Args:
+        measure: The measure ID.
+
+    Returns:
+        A Series of terms, indexed by code. Where codelists share a code, the term
+        from the first codelist is used.
+    """
+    terms = pd.concat(
+        [
+            pd.read_csv(BASE_DIR / "codelists" / f"{name}.csv", index_col="code")[
+                "term"
+            ]
+            for name in SENTINEL_MEASURE_CODELISTS[measure]
+        ]
+    )
+    terms = terms[~terms.index.duplicated()]
+    return terms.str.replace(r"\s*\(procedure\)$", "", regex=True)
+
+
+def get_code_counts(df, code_column, events_column):
+    """Counts the events of each code, as a sparse vector.
+
+    Args:
+        df: A measure table.
+        code_column: The name of the code column.
+        events_column: The name of the column of event counts.
+
+    Returns:
+        A tuple of an array of codes and an array of event counts, sorted by code.
+        Codes without events are left out.
+    """
+    counts = df.groupby(code_column)[events_column].sum()
+    counts = counts[counts > 0]
+    return counts.index.to_numpy(dtype=np.int64), counts.to_numpy(dtype=np.int64)
+
+
+def apply_code_counts_policy(codes, counts, policy):
+    """Applies a disclosure control policy to a sparse vector of event counts.
+
+    Args:
+        codes: An array of codes, as returned by `get_code_counts`.
+        counts: An array of event counts, as returned by `get_code_counts`.
+        policy: A `Policy`.
+
+    Returns:
+        A tuple of an array of codes and an array of controlled event counts, sorted
+        by code. Codes whose counts are suppressed are left out.
+    """
+    controlled = apply_policy(pd.Series(counts, dtype=float), policy).to_numpy()
+    is_released = ~np.isnan(controlled)
+    return codes[is_released], controlled[is_released].astype(np.int64)
+
+
+def save_code_counts(codes, counts, output_path):
+    """Saves a sparse vector of event counts, as returned by `get_code_counts`."""
+    pd.DataFrame({"code": codes, "events": counts}).to_csv(output_path, index=False)
+
+
+def load_code_counts(input_path):
+    """Loads a sparse vector of event counts saved by `save_code_counts`."""
+    df = pd.read_csv(input_path, dtype=np.int64)
+    return df["code"].to_numpy(), df["events"].to_numpy()
+
+
+def merge_code_counts(*code_counts):
+    """Adds sparse vectors of event counts, e.g. from each backend.
+
+    Each vector is sorted by code, so a stable sort of their concatenation merges
+    them in linear time, as a merge of sorted runs.
+
+    Args:
+        *code_counts: Tuples of codes and event counts, as returned by
+            `get_code_counts`.
+
+    Returns:
+        A tuple of an array of codes and an array of the total event counts, sorted
+        by code.
+    """
+    codes = np.concatenate([c for c, _ in code_counts]).astype(np.int64)
+    counts = np.concatenate([n for _, n in code_counts]).astype(np.int64)
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    counts = counts[order]
+
+    is_first = np.ones(len(codes), dtype=bool)
+    is_first[1:] = codes[1:] != codes[:-1]
+    starts = np.flatnonzero(is_first)
+    if len(starts) == 0:
+        return codes, counts
+    return codes[starts], np.add.reduceat(counts, starts)
+
+
 def get_number_practices(df):
     """Gets the number of practices in the given measure table.
 
@@ -234,115 +716,26 @@ def get_number_patients(measure_id):
     return d["num_patients"][measure_id]
 
 
-# https://github.com/ebmdatalab/datalab-pandas/blob/master/ebmdatalab/charts.py
-def deciles_chart_ebm(
-    df,
-    period_column=None,
-    column=None,
-    title="",
-    ylabel="",
-    show_outer_percentiles=True,
-    show_legend=True,
-    ax=None,
-    output_path=None,
-):
-    """period_column must be dates / datetimes"""
-    sns.set_style("whitegrid", {"grid.color": ".9"})
-    if not ax:
-        fig, ax = plt.subplots(1, 1)
-    df = compute_deciles(df, period_column, column, show_outer_percentiles)
-    linestyles = {
-        "decile": {
-            "line": "b--",
-            "linewidth": 1,
-            "label": "decile",
-        },
-        "median": {
-            "line": "b-",
-            "linewidth": 1.5,
-            "label": "median",
-        },
-        "percentile": {
-            "line": "b:",
-            "linewidth": 0.8,
-            "label": "1st-9th, 91st-99th percentile",
-        },
-    }
-    label_seen = []
-    for percentile in range(1, 100):  # plot each decile line
-        data = df[df["percentile"] == percentile]
-        add_label = False
-
-        if percentile == 50:
-            style = linestyles["median"]
-            add_label = True
-        elif show_outer_percentiles and (percentile < 10 or percentile > 90):
-            style = linestyles["percentile"]
-            if "percentile" not in label_seen:
-                label_seen.append("percentile")
-                add_label = True
-        else:
-            style = linestyles["decile"]
-            if "decile" not in label_seen:
-                label_seen.append("decile")
-                add_label = True
-        if add_label:
-            label = style["label"]
-        else:
-            label = "_nolegend_"
-
-        ax.plot(
-            data[period_column],
-            data[column],
-            style["line"],
-            linewidth=style["linewidth"],
-            label=label,
-        )
-    ax.set_ylabel(ylabel, size=15, alpha=0.6)
-    if title:
-        ax.set_title(title, size=18)
-
-    # Replace 'np.inf' and '-np.inf' with 'NaN'
-    df[column].replace([np.inf, -np.inf], np.nan, inplace=True)
-
-    # Drop rows with NaN in the specified column
-    df.dropna(subset=[column], inplace=True)
-
-    if not df[column].empty:
-        ax.set_ylim([0, df[column].max() * 1.05])
-    
-    ax.tick_params(labelsize=12)
-
-    df[period_column].replace([np.inf, -np.inf], np.nan, inplace=True)
-    df.dropna(subset=[period_column], inplace=True)
-
-    if not df[period_column].empty:
-        ax.set_xlim(
-            [df[period_column].min(), df[period_column].max()]
-        )  # set x axis range as full date range
-
-    ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%B %Y"))
-    ax.xaxis.set_major_locator(matplotlib.dates.MonthLocator(interval=1))
-    if show_legend:
-        ax.legend(
-            bbox_to_anchor=(1.05, 0.6),
-            ncol=1,
-            fontsize=12,
-            borderaxespad=0.0,
-            frameon=True,
-        )
+def get_quantiles(has_outer_percentiles=True):
+    """Gets the quantiles that are plotted on a decile chart.
 
-    # rotates and right aligns the x labels, and moves the bottom of the
-    # axes up to make room for them
-    plt.gcf().autofmt_xdate(rotation=90, ha="center", which="both")
-
-    plt.show()
-
-    if output_path:
-        ax.get_figure().savefig(output_path, bbox_inches="tight")
-        
+    Args:
+        has_outer_percentiles: Whether to include the nine largest and nine smallest
+            percentiles as well as the deciles.
 
-    return plt
+    Returns:
+        An array of the deciles, followed by the outer percentiles.
+    """
+    quantiles = np.round(np.arange(0.1, 1, 0.1), 2)
+    if has_outer_percentiles:
+        quantiles = np.concatenate(
+            [
+                quantiles,
+                np.round(np.arange(0.01, 0.1, 0.01), 2),
+                np.round(np.arange(0.91, 1, 0.01), 2),
+            ]
+        )
+    return quantiles
 
 
 def compute_deciles(measure_table, groupby_col, values_col, has_outer_percentiles=True):
@@ -358,242 +751,287 @@ def compute_deciles(measure_table, groupby_col, values_col, has_outer_percentile
     Returns:
         A data frame with `groupby_col`, `values_col`, and `percentile` columns.
     """
-    quantiles = np.round(np.arange(0.1, 1, 0.1), 2)
-    if has_outer_percentiles:
-        quantiles = np.concatenate(
-            [quantiles, np.round(np.arange(0.01, 0.1, 0.01), 2), np.round(np.arange(0.91, 1, 0.01), 2)]
-        )
-    
-    percentiles = (
-        measure_table.groupby(groupby_col)[values_col]
-        .quantile(pd.Series(quantiles))
-        .reset_index()
+    quantiles = get_quantiles(has_outer_percentiles)
+
+    groups, group_values = pd.factorize(measure_table[groupby_col], sort=True)
+    values = measure_table[values_col].to_numpy(dtype=float)
+
+    # sort by group and then by value, once, dropping missing values
+    is_valid = (groups >= 0) & ~np.isnan(values)
+    groups = groups[is_valid]
+    values = values[is_valid]
+    order = np.argsort(values)
+    order = order[np.argsort(groups[order], kind="stable")]
+    # groups without values read the trailing NaN
+    values = np.append(values[order], np.nan)
+
+    counts = np.bincount(groups, minlength=len(group_values))
+    starts = np.where(counts > 0, np.cumsum(counts) - counts, len(values) - 1)
+
+    # linearly interpolate between the closest ranks, as pandas does
+    position = np.maximum(counts[:, np.newaxis] - 1, 0) * quantiles
+    lower = starts[:, np.newaxis] + np.floor(position).astype(int)
+    upper = starts[:, np.newaxis] + np.ceil(position).astype(int)
+    fraction = position - np.floor(position)
+    result = values[lower] + (values[upper] - values[lower]) * fraction
+
+    percentiles = pd.DataFrame(
+        {
+            groupby_col: group_values.repeat(len(quantiles)),
+            "percentile": np.tile(
+                np.rint(quantiles * 100).astype(int), len(group_values)
+            ),
+            values_col: result.ravel(),
+        }
     )
-   
-    percentiles["percentile"] = percentiles["level_1"].apply(lambda x: int(x * 100))
-    percentiles = percentiles.loc[:, [groupby_col, "percentile", values_col]]
     return percentiles
 
 
-def deciles_chart(
-    df,
-    period_column=None,
-    column=None,
-    title="",
-    ylabel="",
-    interactive=True,
-    width=800,
-    height=400,
-    output_path=None,
-):
-    """period_column must be dates / datetimes"""
-
-    df = compute_deciles(df, period_column, column, True)
-
-    if interactive:
+def get_deciles(measure_table, groupby_col, values_col, has_outer_percentiles=True):
+    """Gets deciles, computing them only once for a given measure table.
 
-        fig = go.Figure()
+    Percentile tables are cached on the contents of the `groupby_col` and
+    `values_col` columns, so the PNG and Plotly charts of a measure share a
+    single call to `compute_deciles`. The `DECILES_CACHE_SIZE` most recently used
+    tables are kept.
 
-        linestyles = {
-            "decile": {"color": "blue", "dash": "dash"},
-            "median": {"color": "blue", "dash": "solid"},
-            "percentile": {"color": "blue", "dash": "dash"},
-        }
-
-        for percentile in np.unique(df["percentile"]):
-            df_subset = df[df["percentile"] == percentile]
-            if percentile == 50:
-                fig.add_trace(
-                    go.Scatter(
-                        x=df_subset[period_column],
-                        y=df_subset[column],
-                        line={"color": "blue", "dash": "solid", "width": 1.2},
-                        name="median",
-                    )
-                )
-            else:
-                fig.add_trace(
-                    go.Scatter(
-                        x=df_subset[period_column],
-                        y=df_subset[column],
-                        line={"color": "blue", "dash": "dash", "width": 1},
-                        name=f"decile {int(percentile/10)}",
-                    )
-                )
-
-        # Set title
-        fig.update_layout(
-            title_text=title,
-            hovermode="x",
-            title_x=0.5,
-            width=width,
-            height=height,
-        )
-
-        fig.update_yaxes(title=ylabel)
-        fig.update_xaxes(title="Date")
-
-        # Add range slider
-        fig.update_layout(
-            xaxis=go.layout.XAxis(
-                rangeselector=dict(
-                    buttons=list(
-                        [
-                            dict(
-                                count=1,
-                                label="1m",
-                                step="month",
-                                stepmode="backward",
-                            ),
-                            dict(
-                                count=6,
-                                label="6m",
-                                step="month",
-                                stepmode="backward",
-                            ),
-                            dict(
-                                count=1,
-                                label="1y",
-                                step="year",
-                                stepmode="backward",
-                            ),
-                            dict(step="all"),
-                        ]
-                    )
-                ),
-                rangeslider=dict(visible=True),
-                type="date",
-            )
-        )
-
-        fig.show()
+    Args:
+        measure_table: A measure table.
+        groupby_col: The name of the column to group by.
+        values_col: The name of the column for which deciles are computed.
+        has_outer_percentiles: Whether to compute the nine largest and nine smallest
+            percentiles as well as the deciles.
 
+    Returns:
+        A copy of the data frame returned by `compute_deciles`.
+    """
+    row_hashes = pd.util.hash_pandas_object(
+        measure_table.loc[:, [groupby_col, values_col]], index=False
+    )
+    key = (
+        groupby_col,
+        values_col,
+        has_outer_percentiles,
+        hashlib.sha256(row_hashes.to_numpy().tobytes()).hexdigest(),
+    )
+    if key in DECILES_CACHE:
+        DECILES_CACHE.move_to_end(key)
     else:
-        px = 1 / plt.rcParams["figure.dpi"]  # pixel in inches
-        fig, ax = plt.subplots(
-            1, 1, figsize=(width * px, height * px), tight_layout=True
+        DECILES_CACHE[key] = compute_deciles(
+            measure_table, groupby_col, values_col, has_outer_percentiles
         )
+        while len(DECILES_CACHE) > DECILES_CACHE_SIZE:
+            DECILES_CACHE.popitem(last=False)
+    return DECILES_CACHE[key].copy()
 
-        deciles_chart_ebm(
-            df,
-            period_column=period_column,
-            column=column,
-            ylabel="rate per 1000",
-            show_outer_percentiles=True,
-            ax=ax,
-            output_path=output_path,
-        )
 
+class MeasureMatrix:
+    """A practice-level measure table as dense practice × date arrays.
 
-def generate_sentinel_measure(
-    data_dict,
-    data_dict_practice,
-    codelist_dict,
-    measure,
-    code_column,
-    term_column,
-    dates_list,
-    codelist_links,
-    interactive=True,
-):
-    """Generates tables and charts for the measure with the given ID.
+    Each row of `numerator` and `denominator` is a practice and each column is
+    a date. Cells without a row in the measure table are NaN.
 
-    Args:
-        data_dict: A mapping of measure IDs to measure tables.
-        data_dict_practice: A mapping of measure IDs to "practice only" measure tables.
-        codelist_dict: A mapping of measure IDs to codelist tables.
-        measure: A measure ID.
-        code_column: The name of the code column in the codelist table.
-        term_column: The name of the term column in the codelist table.
-        dates_list: Not used.
-        interactive: Flag indicating whether or not the chart should be interactive.
+    Attributes:
+        practices: The practice IDs, sorted.
+        dates: The dates, sorted.
+        numerator: A 2-D array of numerators.
+        denominator: A 2-D array of denominators.
     """
-    df = data_dict[measure]
 
-    childs_df, childs_df_with_count = create_child_table(
-        df, codelist_dict[measure], code_column, term_column, measure
-    )
+    def __init__(self, practices, dates, numerator, denominator):
+        self.practices = practices
+        self.dates = dates
+        self.numerator = numerator
+        self.denominator = denominator
+
+    @classmethod
+    def from_long(
+        cls, df, numerator, denominator, practice_col="practice", date_col="date"
+    ):
+        """Makes a measure matrix from a long-format measure table.
+
+        Rows for the same practice and date, such as those for different codes,
+        are summed.
+
+        Args:
+            df: A measure table.
+            numerator: The name of the numerator column.
+            denominator: The name of the denominator column.
+            practice_col: The name of the practice column.
+            date_col: The name of the date column.
+        """
+        practice_codes, practices = pd.factorize(df[practice_col], sort=True)
+        date_codes, dates = pd.factorize(df[date_col], sort=True)
+        is_valid = (practice_codes >= 0) & (date_codes >= 0)
+        cells = practice_codes[is_valid] * len(dates) + date_codes[is_valid]
+        shape = (len(practices), len(dates))
+        size = shape[0] * shape[1]
+
+        is_present = np.bincount(cells, minlength=size) > 0
+
+        def to_matrix(values):
+            values = np.asarray(values, dtype=float)[is_valid]
+            matrix = np.bincount(cells, weights=values, minlength=size)
+            return np.where(is_present, matrix, np.nan).reshape(shape)
+
+        return cls(
+            practices.to_numpy(),
+            dates.to_numpy(),
+            to_matrix(df[numerator]),
+            to_matrix(df[denominator]),
+        )
 
-    practices_included = get_number_practices(df)
-    practices_included_percent = get_percentage_practices(df)
+    def to_long(self, numerator, denominator, practice_col="practice", date_col="date"):
+        """Makes a long-format measure table, with a row per non-empty cell.
+
+        Args:
+            numerator: The name of the numerator column.
+            denominator: The name of the denominator column.
+            practice_col: The name of the practice column.
+            date_col: The name of the date column.
+        """
+        practice_idx, date_idx = np.nonzero(
+            ~(np.isnan(self.numerator) & np.isnan(self.denominator))
+        )
+        return pd.DataFrame(
+            {
+                practice_col: self.practices[practice_idx],
+                date_col: self.dates[date_idx],
+                numerator: self.numerator[practice_idx, date_idx],
+                denominator: self.denominator[practice_idx, date_idx],
+            }
+        )
 
-    num_events, num_events_mil = get_number_events_mil(df, measure)
+    def drop_irrelevant_practices(self):
+        """Drops practices with zero events during the study period.
+
+        Returns:
+            A new measure matrix.
+        """
+        is_relevant = np.any(np.nan_to_num(self.numerator) != 0, axis=1)
+        return MeasureMatrix(
+            self.practices[is_relevant],
+            self.dates,
+            self.numerator[is_relevant],
+            self.denominator[is_relevant],
+        )
 
-    num_patients = get_number_patients(measure)
+    def rates(self):
+        """Gets the number of events per 1,000 of the population.
+
+        Returns:
+            A 2-D array of rates.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.numerator / (self.denominator / 1000)
+
+    def quantiles(self, quantiles):
+        """Gets the given quantiles of the rates, for each date.
+
+        Missing rates are ignored. Quantiles are linearly interpolated between the
+        closest ranks, as pandas does.
+
+        Args:
+            quantiles: A 1-D array of quantiles, between 0 and 1.
+
+        Returns:
+            A 2-D array with a row per quantile and a column per date.
+        """
+        rates = np.sort(self.rates(), axis=0)  # NaNs are sorted to the end
+        counts = np.sum(~np.isnan(rates), axis=0)
+        rates = np.vstack([rates, np.full(len(self.dates), np.nan)])
+
+        position = np.maximum(counts - 1, 0) * np.asarray(quantiles)[:, np.newaxis]
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        # dates without rates read the trailing NaN row
+        lower[:, counts == 0] = upper[:, counts == 0] = len(rates) - 1
+        lower_values = np.take_along_axis(rates, lower, axis=0)
+        upper_values = np.take_along_axis(rates, upper, axis=0)
+        return lower_values + (upper_values - lower_values) * (
+            position - np.floor(position)
+        )
 
-    num_practices_df = pd.DataFrame(
-        {"num_practices_included": pd.Series([practices_included])}
-    )
-    num_practices_df.to_csv(
-        f"{OUTPUT_DIR}/num_practices_included_{measure}.csv", index=False
-    )
+    def compute_deciles(self, has_outer_percentiles=True, date_col="date"):
+        """Computes the deciles of the rates.
+
+        Args:
+            has_outer_percentiles: Whether to compute the nine largest and nine
+                smallest percentiles as well as the deciles.
+            date_col: The name of the date column.
+
+        Returns:
+            A data frame with `date_col`, `percentile`, and `rate` columns, like
+            the one returned by `compute_deciles`.
+        """
+        quantiles = get_quantiles(has_outer_percentiles)
+        values = self.quantiles(quantiles)
+        return pd.DataFrame(
+            {
+                date_col: np.repeat(self.dates, len(quantiles)),
+                "percentile": np.tile(
+                    np.rint(quantiles * 100).astype(int), len(self.dates)
+                ),
+                "rate": values.T.ravel(),
+            }
+        )
 
-    df = data_dict_practice[measure]
 
-    deciles_chart(
-        df,
-        period_column="date",
-        column="rate",
-        ylabel="rate per 1000",
-        interactive=interactive,
-    )
+IMD_QUINTILE_LABELS = ["Most deprived", "2", "3", "4", "Least deprived"]
 
-    display(
-        Markdown(f"Practices included: {practices_included} ({practices_included_percent:.2f}%)"),
-    )
 
-    childs_df = childs_df.rename(columns={code_column: code_column.title()})
-    childs_df.to_csv(f"{OUTPUT_DIR}/code_table_{measure}.csv")
+def get_imd_quintile_bins(imd):
+    """Gets the boundaries of the IMD quintiles, so they can be reused across measures.
 
-    childs_df_with_count = childs_df_with_count.rename(
-        columns={code_column: code_column.title()}
-    )
-    childs_df_with_count.to_csv(f"{OUTPUT_DIR}/code_table_{measure}_with_count.csv")
+    Args:
+        imd: The IMD of each patient or practice.
 
-    if len(codelist_links)>1:
-        display(
-            Markdown(f"#### Most Common Codes <a href={codelist_links[0]}>(Codelist 1)</a>, <a href={codelist_links[1]}>(Codelist 2)</a>"),
-            HTML(childs_df.to_html(index=False)),
-        )
+    Returns:
+        An array of the unique bin edges, as `pd.qcut` would compute them.
+    """
+    imd = pd.to_numeric(pd.Series(imd)).dropna()
+    return np.unique(np.quantile(imd, np.linspace(0, 1, 6)))
 
-    else:
-        display(
-            Markdown(f"#### Most Common Codes <a href={codelist_links[0]}>(Codelist)</a>"),
-            HTML(childs_df.to_html(index=False)),
-        )
 
-    display(
-        Markdown(f"Total patients: {num_patients:.2f}M ({num_events_mil:.2f}M events)"),
-    )
+def calculate_imd_group(df, disease_column, rate_column, bins=None):
+    """Calculates the mean rate and the totals by date, IMD quintile and practice.
 
-    return df, num_events
+    The input frame isn't changed. Only combinations of date, IMD quintile and
+    practice that are in the input are returned.
 
+    Args:
+        df: A measure table with `date`, `imd`, `practice` and `population` columns.
+        disease_column: The name of the numerator column.
+        rate_column: The name of the rate column.
+        bins: The boundaries of the IMD quintiles, from `get_imd_quintile_bins`.
+            Defaults to the quintiles of `df`.
 
-def calculate_imd_group(df, disease_column, rate_column):
+    Returns:
+        A data frame with `date`, `imd` and `practice` columns, the mean of
+        `rate_column` and the sums of `disease_column` and `population`.
+    """
     imd_column = pd.to_numeric(df["imd"])
-    df["imd"] = pd.qcut(
+    if bins is None:
+        bins = get_imd_quintile_bins(imd_column)
+    imd = pd.cut(
         imd_column,
-        q=5,
-        duplicates="drop",
-        labels=["Most deprived", "2", "3", "4", "Least deprived"],
-    )
-
-    df_rate = (
-        df.groupby(by=["date", "imd", "practice"])[[rate_column]].mean().reset_index()
-    )
-
-    df_population = (
-        df.groupby(by=["date", "imd", "practice"])[[disease_column, "population"]]
-        .sum()
+        bins,
+        labels=IMD_QUINTILE_LABELS[: len(bins) - 1],
+        include_lowest=True,
+    ).rename("imd")
+
+    return (
+        df.groupby(["date", imd, "practice"], observed=True)
+        .agg(
+            **{
+                rate_column: (rate_column, "mean"),
+                disease_column: (disease_column, "sum"),
+                "population": ("population", "sum"),
+            }
+        )
         .reset_index()
     )
 
-    df_merged = df_rate.merge(
-        df_population, on=["date", "imd", "practice"], how="inner"
-    )
-
-    return df_merged
-
 
 def redact_small_numbers(df, n, numerator, denominator, rate_column, date_column):
     """
@@ -606,40 +1044,23 @@ def redact_small_numbers(df, n, numerator, denominator, rate_column, date_column
     numerator: numerator column to be redacted
     denominator: denominator column to be redacted
     """
+    # group rows by date, in order of first appearance
+    dates = pd.factorize(df[date_column])[0]
+    order = np.argsort(dates, kind="stable")
+    order = order[dates[order] >= 0]
+    df = df.iloc[order].copy()
+    dates = dates[order]
+
+    df = apply_policy(
+        df,
+        Policy(threshold=n, base=None, secondary=True),
+        columns=[numerator, denominator],
+        groups=dates,
+    )
 
-    def suppress_column(column):
-        suppressed_count = column[column <= n].sum()
-
-        # if 0 dont need to suppress anything
-        if suppressed_count == 0:
-            pass
-
-        else:
-            column[column <= n] = np.nan
-
-            while suppressed_count <= n:
-                suppressed_count += column.min()
-
-                column[column.idxmin()] = np.nan
-        return column
-
-    df_list = []
-
-    dates = df[date_column].unique()
-
-    for d in dates:
-        df_subset = df.loc[df[date_column] == d, :]
-
-        for column in [numerator, denominator]:
-            df_subset[column] = suppress_column(df_subset[column])
-
-        df_subset.loc[
-            (df_subset[numerator].isna()) | (df_subset[denominator].isna()),
-            rate_column,
-        ] = np.nan
-        df_list.append(df_subset)
+    df.loc[(df[numerator].isna()) | (df[denominator].isna()), rate_column] = np.nan
 
-    return pd.concat(df_list, axis=0)
+    return df
 
 
 def calculate_statistics(df, baseline_date, comparative_dates):
@@ -653,85 +1074,121 @@ def calculate_statistics(df, baseline_date, comparative_dates):
     returns:
         list of % differences
     """
-    median_baseline = round(df[df["date"] == baseline_date]["rate"].median(), 2)
-    differences = []
-    values = []
-    for date in comparative_dates:
-        value = round(df[df["date"] == date]["rate"].median(), 2)
-        difference = round(((value - median_baseline) / median_baseline) * 100, 2)
-        differences.append(difference)
-        values.append(round(value, 2))
+    table = calculate_statistics_table({None: df}, baseline_date, comparative_dates)
+    return table["baseline"].iloc[0], list(table["value"]), list(table["change"])
 
-    return median_baseline, values, differences
 
+def calculate_statistics_table(measure_tables, baseline_date, comparative_dates):
+    """Calculates the % change in the median rate between dates, for many measures.
 
-def classify_changes(changes):
-    """Classifies list of % changes
+    The medians of every measure and date are computed in one groupby.
 
     Args:
-        changes: list of percentage changes
-    """
-
-    if (-15 <= changes[0] < 15) and (-15 <= changes[1] < 15):
-        classification = "no change"
+        measure_tables: A dict of measure IDs to measure tables with `date` and
+            `rate` columns.
+        baseline_date: The date to use as the baseline. Format: YYYY-MM-DD.
+        comparative_dates: A list of dates to compare to the baseline.
 
-    elif (changes[0] > 15) or (changes[1] > 15):
-        classification = "increase"
-
-    elif (changes[0] <= -15) and not (-15 <= changes[1] < 15):
-        classification = "sustained drop"
+    Returns:
+        A data frame with a row per measure and comparative date, with `measure`,
+        `baseline_date`, `baseline`, `date`, `value`, `change` and `classification`
+        columns. Medians and changes are rounded to 2DP. The classification is of the
+        changes at the first two comparative dates.
+    """
+    dates = [baseline_date] + list(comparative_dates)
+    num_dates = len(dates)
+
+    # a date may be given more than once, e.g. as the baseline and a comparative
+    # date, so medians are computed for each unique date and then repeated
+    date_codes, unique_dates = pd.factorize(pd.Series(dates))
+    num_unique_dates = len(unique_dates)
+
+    keys = []
+    rates = []
+    for i, df in enumerate(measure_tables.values()):
+        if is_datetime64_any_dtype(df["date"]):
+            date_index = pd.DatetimeIndex(pd.to_datetime(unique_dates))
+        else:
+            date_index = pd.Index(unique_dates)
+        row_codes = date_index.get_indexer(df["date"])
+        is_compared = row_codes >= 0
+        keys.append(i * num_unique_dates + row_codes[is_compared])
+        rates.append(df["rate"].to_numpy()[is_compared])
+
+    num_cells = len(measure_tables) * num_unique_dates
+    medians = (
+        pd.Series(np.concatenate(rates) if rates else [], dtype=float)
+        .groupby(np.concatenate(keys) if keys else [])
+        .median()
+        .reindex(range(num_cells))
+        .to_numpy()
+        .reshape(len(measure_tables), num_unique_dates)[:, date_codes]
+        .round(2)
+    )
 
-    elif (changes[0] <= -15) and (-15 <= changes[1] < 15):
-        classification = "recovery"
+    baseline = medians[:, :1]
+    values = medians[:, 1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        changes = (((values - baseline) / baseline) * 100).round(2)
 
+    if changes.shape[1] >= 2:
+        classifications = get_change_classifications(changes[:, 0], changes[:, 1])
     else:
-        classification = "none"
-
-    display(Markdown(f"Overall classification: **{classification}**"))
+        classifications = np.full(len(measure_tables), None)
+
+    num_comparative_dates = num_dates - 1
+    return pd.DataFrame(
+        {
+            "measure": np.repeat(list(measure_tables), num_comparative_dates),
+            "baseline_date": baseline_date,
+            "baseline": np.repeat(baseline[:, 0], num_comparative_dates),
+            "date": np.tile(dates[1:], len(measure_tables)),
+            "value": values.ravel(),
+            "change": changes.ravel(),
+            "classification": np.repeat(classifications, num_comparative_dates),
+        }
+    )
 
 
-def display_changes(baseline, values, changes, dates):
-    """Display % changes at given dates
+def get_change_classifications(first_changes, second_changes):
+    """Classifies pairs of % changes, e.g. at the first and second year of the pandemic.
 
     Args:
-        changes: list of % changes
-        dates: list of readable dates changes refer to
-    """
-
-    for value, change, date in zip(values, changes, dates):
-        display(
-            Markdown(
-                f"Change in median from April 2019 ({baseline}) - {date} ({value}): **{change}%**"
-            )
-        )
-
-
-def match_input_files(file: str) -> bool:
-    """Checks if file name has format outputted by cohort extractor"""
-    pattern = r"^input_20\d\d-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01])\.feather"
-    return True if re.match(pattern, file) else False
-
-
-def get_date_input_file(file: str) -> str:
-    """Gets the date in format YYYY-MM-DD from input file name string"""
-    # check format
-    if not match_input_files(file):
-        raise Exception("Not valid input file format")
+        first_changes: An array of the first % changes.
+        second_changes: An array of the second % changes.
 
-    else:
-        date = result = re.search(r"input_(.*)\.feather", file)
-        return date.group(1)
+    Returns:
+        An array of "no change", "increase", "sustained drop", "recovery" or "none".
+    """
+    first_changes = np.asarray(first_changes, dtype=float)
+    second_changes = np.asarray(second_changes, dtype=float)
+    first_is_stable = (-15 <= first_changes) & (first_changes < 15)
+    second_is_stable = (-15 <= second_changes) & (second_changes < 15)
+    first_is_drop = first_changes <= -15
+
+    return np.select(
+        [
+            first_is_stable & second_is_stable,
+            (first_changes > 15) | (second_changes > 15),
+            first_is_drop & ~second_is_stable,
+            first_is_drop & second_is_stable,
+        ],
+        ["no change", "increase", "sustained drop", "recovery"],
+        default="none",
+    )
 
 
-def produce_stripped_measures(df, sentinel_measure):
+def produce_stripped_measures(df, sentinel_measure, drop_irrelevant=True):
     """Takes in a practice level measures file, calculates rate and strips
     persistent id,including only a rate and date column. Rates are rounded
     and the df is randomly shuffled to remove any potentially predictive ordering.
+    Pass drop_irrelevant=False if irrelevant practices have already been dropped.
     Returns stripped df
     """
 
     # drop irrelevant practices
-    df = drop_irrelevant_practices(df)
+    if drop_irrelevant:
+        df = drop_irrelevant_practices(df)
 
     # calculate rounded rate
     calculate_rate(df, sentinel_measure, "population", round_rate=True)
@@ -742,10 +1199,8 @@ def produce_stripped_measures(df, sentinel_measure):
 
 def match_input_files(file: str) -> bool:
     """Checks if file name has format outputted by cohort extractor"""
-    pattern = (
-        r"^input_population_20\d\d-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01])\.feather"
-    )
-    return True if re.match(pattern, file) else False
+    extract = parse_extract_name(file)
+    return extract is not None and extract[1] is not None
 
 
 def get_date_input_file(file: str) -> str:
@@ -755,14 +1210,118 @@ def get_date_input_file(file: str) -> str:
         raise Exception("Not valid input file format")
 
     else:
-        date = result = re.search(r"input_population_(.*)\.feather", file)
-        return date.group(1)
+        return parse_extract_name(file)[1]
+
+
+def get_input_files(input_dir=None, prefix="input"):
+    """Gets the monthly extracts in the given directory, sorted by date.
+
+    The extracts are listed from the catalogue; use `catalogue.get_extracts` to get
+    their row counts and schemas too.
+
+    Args:
+        input_dir: The directory containing the extracts. Defaults to `OUTPUT_DIR`.
+        prefix: The file name prefix of the extracts, "input" or "input_population".
+
+    Returns:
+        A list of paths to files named `<prefix>_YYYY-MM-DD.feather`.
+    """
+    if input_dir is None:
+        input_dir = OUTPUT_DIR
+    return [extract["path"] for extract in get_extracts(input_dir, PREFIXES[prefix])]
+
+
+def read_input_files(
+    columns=None, input_dir=None, prefix="input", max_workers=4, files=None
+):
+    """Reads the monthly extracts concurrently, in date order.
+
+    Files are read across a thread pool, with at most `max_workers` extracts read
+    ahead of the one being processed, so memory is bounded by a few extracts
+    rather than the whole study period.
+
+    Args:
+        columns: The columns to read. Defaults to all columns.
+        input_dir: The directory containing the extracts. Defaults to `OUTPUT_DIR`.
+        prefix: The file name prefix of the extracts, e.g. "input_population".
+        max_workers: The number of extracts to read concurrently.
+        files: The paths to the extracts to read. Defaults to those returned by
+            `get_input_files`.
+
+    Yields:
+        Tuples of the path to each extract and the extract.
+    """
+    if files is None:
+        files = get_input_files(input_dir, prefix)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file in files:
+            pending.append(
+                (file, executor.submit(pd.read_feather, file, columns=columns))
+            )
+            if len(pending) >= max_workers:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+
+def sort_lookup_table(lookup, key="patient_id"):
+    """Sorts a lookup table by its key, so that it can be searched by
+    `append_lookup_columns`.
+
+    Args:
+        lookup: An Arrow table with a row per key.
+        key: The name of the key column.
+
+    Returns:
+        The sorted Arrow table.
+    """
+    keys = lookup[key].to_numpy()
+    order = np.argsort(keys, kind="stable")
+    if np.any(keys[order][1:] == keys[order][:-1]):
+        raise ValueError(f"The lookup table has duplicate values of {key}")
+    return lookup.take(pa.array(order))
+
+
+def append_lookup_columns(table, lookup, key="patient_id"):
+    """Appends the columns of a lookup table to an Arrow table, matching on a key.
+
+    Keys are found with a binary search of the sorted lookup table, and existing
+    columns are kept as they are rather than copied. Rows without a match have nulls
+    in the appended columns, as with a left join. Columns that are already in the
+    table are replaced, so joining the same lookup table again changes nothing.
+
+    Args:
+        table: An Arrow table.
+        lookup: An Arrow table sorted by `sort_lookup_table`.
+        key: The name of the key column in both tables.
+
+    Returns:
+        An Arrow table with the columns of `table`, then those of `lookup`.
+    """
+    keys = lookup[key].to_numpy()
+    values = table[key].to_numpy()
+    positions = np.minimum(np.searchsorted(keys, values), max(len(keys) - 1, 0))
+    is_match = keys[positions] == values if len(keys) else np.zeros(len(values), bool)
+    indices = pa.array(positions, mask=~is_match)
+
+    for name in lookup.column_names:
+        if name == key:
+            continue
+        column = lookup[name].take(indices)
+        if name in table.column_names:
+            table = table.set_column(table.column_names.index(name), name, column)
+        else:
+            table = table.append_column(name, column)
+    return table
 
 
 def get_patients_left_tpp(df, df_comparison, demographics):
-    """Identifies patients not in a given monthly extract who were in another (previous extract).
-    Excludes patients who are not present because they have since died. Extracts demographics
-    for these patients.
+    """Identifies patients not in a given monthly extract who were in another
+    (previous extract). Excludes patients who are not present because they have
+    since died. Extracts demographics for these patients.
 
     Args:
         df: input dataframe to identify patients in
@@ -777,13 +1336,11 @@ def get_patients_left_tpp(df, df_comparison, demographics):
     patients_left = df_comparison.loc[
         ~df_comparison["patient_id"].isin(df.loc[:, "patient_id"]), "patient_id"
     ]
-   
+
     # demographics of those people in a given month (from first month)
     demographics_patients_left = (
-        df_comparison.loc[
-            df_comparison["patient_id"].isin(patients_left),
-            :
-        ].reindex(columns = ["patient_id"] + demographics)
+        df_comparison.loc[df_comparison["patient_id"].isin(patients_left), :]
+        .reindex(columns=["patient_id"] + demographics)
         .reset_index()
         .drop(["index"], axis=1)
     )
@@ -796,15 +1353,16 @@ def get_patients_left_tpp(df, df_comparison, demographics):
 def get_patients_joined_tpp(
     df, df_first_month, age_column, age_start_column, demographics
 ):
-    """Identifies patients in a given monthly extract who are not in another (previous extract).
-    Excludes patients if they are present because they now satisfy the age criteria. Extracts demographics
-    for these patients.
+    """Identifies patients in a given monthly extract who are not in another
+    (previous extract). Excludes patients if they are present because they now
+    satisfy the age criteria. Extracts demographics for these patients.
 
     Args:
         df: input dataframe to identify patients in
         df_comparison: input dataframe to compare to. This should be earlier than df.
         age_column: colum in df that identifies the age of a patient in that month.
-        age_start_column: column in df that identifies the age of a patient at the start.
+        age_start_column: column in df that identifies the age of a patient at the
+            start.
         demographics: list of demographics to extract for patients who have left.
 
     returns:
@@ -812,9 +1370,7 @@ def get_patients_joined_tpp(
     """
 
     # any patients in monthly cohort who didn't become eligible by turning 18 in study
-    patients_adults = df.loc[
-        ~(df[age_start_column] <= 17), "patient_id"
-    ]
+    patients_adults = df.loc[~(df[age_start_column] <= 17), "patient_id"]
 
     # anyone of these patients who were not in the first month
     patients_joined = patients_adults[
@@ -822,11 +1378,8 @@ def get_patients_joined_tpp(
     ]
 
     demographics_patients_joined = (
-        
-        df.loc[
-            df["patient_id"].isin(patients_joined),
-            :
-        ].reindex(columns = ["patient_id"] + demographics)
+        df.loc[df["patient_id"].isin(patients_joined), :]
+        .reindex(columns=["patient_id"] + demographics)
         .reset_index()
         .drop(["index"], axis=1)
     )
@@ -836,28 +1389,306 @@ def get_patients_joined_tpp(
     return demographics_patients_joined
 
 
+class PatientPresence:
+    """Records the patients in each monthly extract as a bit vector.
+
+    Each patient ID is assigned a dense integer the first time it is seen, which is
+    the patient's position in every bit vector. Bit vectors are packed, so each month
+    costs one bit per patient seen so far.
+
+    Attributes:
+        patient_ids: The patient IDs, in order of their positions.
+        months: A mapping of months to packed bit vectors.
+    """
+
+    def __init__(self):
+        self.patient_ids = pd.Index([], dtype="int64")
+        self.months = {}
+
+    def get_positions(self, patient_ids):
+        """Gets the positions of the given patients, assigning positions to new ones.
+
+        Args:
+            patient_ids: An array-like of patient IDs.
+
+        Returns:
+            An array of positions, aligned with `patient_ids`.
+        """
+        patient_ids = np.asarray(patient_ids)
+        positions = self.patient_ids.get_indexer(patient_ids)
+        is_new = positions == -1
+        if is_new.any():
+            codes, new_ids = pd.factorize(patient_ids[is_new])
+            positions[is_new] = len(self.patient_ids) + codes
+            self.patient_ids = self.patient_ids.append(pd.Index(new_ids))
+        return positions
+
+    def add_month(self, month, patient_ids):
+        """Records the patients in a month.
+
+        Args:
+            month: The month, e.g. "2019-01-01".
+            patient_ids: An array-like of the patient IDs in the month.
+        """
+        positions = self.get_positions(patient_ids)
+        bits = np.zeros(len(self.patient_ids), dtype=bool)
+        bits[positions] = True
+        self.months[month] = np.packbits(bits)
+
+    def get_month(self, month):
+        """Gets the packed bit vector of the patients in a month.
+
+        Bit vectors of earlier months are padded with zeros, so that all bit vectors
+        have the same length and can be combined with bitwise operators.
+        """
+        bits = self.months[month]
+        num_bytes = -(-len(self.patient_ids) // 8)
+        return np.pad(bits, (0, num_bytes - len(bits)))
+
+    def is_present(self, month, patient_ids):
+        """Tests whether each of the given patients is in a month.
+
+        Returns:
+            A boolean array, aligned with `patient_ids`.
+        """
+        positions = self.get_positions(patient_ids)
+        bits = np.unpackbits(self.get_month(month), count=len(self.patient_ids))
+        return bits[positions].astype(bool)
+
+    def get_left(self, month, since):
+        """Gets the bit vector of patients in `since` who aren't in `month`."""
+        return self.get_month(since) & ~self.get_month(month)
+
+    def get_joined(self, month, since):
+        """Gets the bit vector of patients in `month` who weren't in `since`."""
+        return self.get_month(month) & ~self.get_month(since)
+
+    def to_patient_ids(self, bits):
+        """Gets the patient IDs that are set in a packed bit vector."""
+        bits = np.unpackbits(bits, count=len(self.patient_ids)).astype(bool)
+        return self.patient_ids[bits].to_numpy()
+
+
+class LatestRows:
+    """Accumulates rows, keeping only the latest row for each key.
+
+    Frames are pushed in order; a row replaces any earlier row with the same key.
+    Pushed rows are buffered in memory until they exceed `max_bytes`, when they are
+    deduplicated, split into buckets by a hash of their key, and spilled to Feather
+    files. Because every row with a given key is in the same bucket, the latest rows
+    can be read back one bucket at a time.
+
+    Args:
+        key: The name of the column that identifies a row, e.g. "patient_id".
+        max_bytes: The memory budget for buffered rows, in bytes.
+        num_buckets: The number of buckets to spill rows into.
+        spill_dir: The directory to spill rows to. Defaults to a temporary directory
+            that is removed when the accumulator is closed.
+    """
+
+    def __init__(self, key, max_bytes=2 ** 30, num_buckets=16, spill_dir=None):
+        self.key = key
+        self.max_bytes = max_bytes
+        self.num_buckets = num_buckets
+        self.spill_dir = spill_dir
+        self._temp_dir = None
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._num_spills = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Removes the temporary spill directory, if there is one."""
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
+
+    def push(self, df):
+        """Adds the rows of a frame, which replace earlier rows with the same keys."""
+        self._buffer.append(df)
+        self._buffered_bytes += df.memory_usage(index=False, deep=True).sum()
+        if self._buffered_bytes > self.max_bytes:
+            self._spill()
+
+    def _get_buffered_rows(self):
+        if not self._buffer:
+            return None
+        return pd.concat(self._buffer, ignore_index=True).drop_duplicates(
+            subset=self.key, keep="last"
+        )
+
+    def _get_buckets(self, df):
+        hashes = pd.util.hash_pandas_object(df[self.key], index=False).to_numpy()
+        return hashes % self.num_buckets
+
+    def _spill(self):
+        if self.spill_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory()
+            self.spill_dir = self._temp_dir.name
+
+        df = self._get_buffered_rows()
+        for bucket, rows in df.groupby(self._get_buckets(df)):
+            path = Path(self.spill_dir) / f"bucket={bucket}"
+            path.mkdir(parents=True, exist_ok=True)
+            rows.reset_index(drop=True).to_feather(
+                path / f"part-{self._num_spills:05d}.feather"
+            )
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._num_spills += 1
+
+    def iter_latest_rows(self):
+        """Iterates over the latest rows, in frames of disjoint keys.
+
+        Yields:
+            A frame of latest rows for each bucket, or a single frame if no rows were
+            spilled.
+        """
+        buffered = self._get_buffered_rows()
+        if self._num_spills == 0:
+            if buffered is not None:
+                yield buffered
+            return
+
+        if buffered is not None:
+            buffered_buckets = self._get_buckets(buffered)
+        for bucket in range(self.num_buckets):
+            parts = [
+                pd.read_feather(f)
+                for f in sorted((Path(self.spill_dir) / f"bucket={bucket}").glob("*"))
+            ]
+            if buffered is not None:
+                parts.append(buffered[buffered_buckets == bucket])
+            if parts:
+                yield pd.concat(parts, ignore_index=True).drop_duplicates(
+                    subset=self.key, keep="last"
+                )
+
+
+def count_patients_moved(latest_rows, threshold=10, base=5):
+    """Counts the patients who moved, and the patients who moved by demographic.
+
+    Demographic counts at or below `threshold` are suppressed, and the remaining
+    counts are rounded to the nearest `base`.
+
+    Args:
+        latest_rows: A `LatestRows` keyed by patient ID.
+        threshold: The largest count to suppress.
+        base: The base to round counts to.
+
+    Returns:
+        The number of patients who moved, and a dict of demographics to dicts of
+        demographic values to counts. Suppressed counts are NaN.
+    """
+    total_moved = 0
+    counts = {}
+    for df in latest_rows.iter_latest_rows():
+        total_moved += len(df)
+        for name, values in df.items():
+            if name != latest_rows.key:
+                counts.setdefault(name, []).append(values.value_counts(dropna=False))
+
+    dem_counts = {}
+    for name, value_counts in counts.items():
+        count = (
+            pd.concat(value_counts)
+            .groupby(level=0, dropna=False, sort=False)
+            .sum()
+            .sort_values(ascending=False, kind="stable")
+        )
+        count = apply_policy(count, Policy(threshold=threshold, base=base))
+        dem_counts[name] = {
+            key: value if np.isnan(value) else int(value)
+            for key, value in count.items()
+        }
+
+    return total_moved, dem_counts
+
+
 def concatenate_patients_moved(moved):
-    moved_df = pd.concat(moved)
     # this will contain duplicates. Take the last entry (most recent demographics)
-    moved_df = moved_df.drop_duplicates(subset="patient_id", keep="last")
+    with LatestRows("patient_id") as latest_rows:
+        for df in moved:
+            latest_rows.push(df)
+        return count_patients_moved(latest_rows)
 
-    total_moved = len(moved_df["patient_id"].unique())
 
-    dem_counts = {}
-    for name, values in moved_df.iteritems():
-        if name != "patient_id":
+def summarise_extract(df, measures):
+    """Summarises a monthly extract.
 
-            count = values.value_counts(dropna=False).to_dict()
-            for key, value in count.items():
-                if value <=10:
-                    value = np.nan
-                
-                count[key] = round_values(value, 5)
-                
+    Summaries of several extracts can be merged with `merge_extract_summaries`,
+    without reading the extracts again.
 
-            dem_counts[name] = count
+    Args:
+        df: A monthly extract with `practice` and `patient_id` columns, and a binary
+            column per measure.
+        measures: The measure IDs.
 
-    return total_moved, dem_counts
+    Returns:
+        A dict with the sorted, unique "practices"; a dict of measure IDs to the
+        sorted, unique "patients" with an event; and a dict of measure IDs to the
+        number of "events".
+    """
+    patient_ids = df["patient_id"].to_numpy()
+    return {
+        "practices": np.unique(df["practice"].to_numpy()),
+        "patients": {
+            m: np.unique(patient_ids[df[m].to_numpy() == 1]) for m in measures
+        },
+        "events": {m: int(df[m].sum()) for m in measures},
+    }
+
+
+def merge_extract_summaries(summaries):
+    """Merges summaries returned by `summarise_extract`.
+
+    Args:
+        summaries: A list of summaries of the same measures.
+
+    Returns:
+        A summary of all the extracts.
+    """
+    measures = summaries[0]["events"].keys() if summaries else []
+    return {
+        "practices": np.unique(np.concatenate([s["practices"] for s in summaries]))
+        if summaries
+        else np.array([], dtype=int),
+        "patients": {
+            m: np.unique(np.concatenate([s["patients"][m] for s in summaries]))
+            for m in measures
+        },
+        "events": {m: sum(s["events"][m] for s in summaries) for m in measures},
+    }
+
+
+def save_extract_summary(summary, path):
+    """Saves a summary returned by `summarise_extract` as an .npz file."""
+    measures = list(summary["events"])
+    np.savez(
+        path,
+        practices=summary["practices"],
+        measures=np.array(measures, dtype=str),
+        events=np.array([summary["events"][m] for m in measures], dtype=np.int64),
+        **{f"patients_{m}": summary["patients"][m] for m in measures},
+    )
+
+
+def load_extract_summary(path):
+    """Loads a summary saved by `save_extract_summary`."""
+    with np.load(path) as f:
+        measures = f["measures"].tolist()
+        summary = {
+            "practices": f["practices"],
+            "patients": {m: f[f"patients_{m}"] for m in measures},
+            "events": dict(zip(measures, f["events"].tolist())),
+        }
+    return summary
 
 
 def save_dict_as_json(dict, output_path):
@@ -865,11 +1696,20 @@ def save_dict_as_json(dict, output_path):
     with open(output_path, "w") as f:
         json.dump(dict, f)
 
+
 def round_values(x, base=5):
+    """Rounds a scalar to the nearest `base`.
+
+    Use `disclosure.round_to_base` for arrays.
+    """
     rounded = x
     if isinstance(x, (int, float)):
         if np.isnan(x):
             rounded = np.nan
         else:
-            rounded = int(base * round(x / base))
+            rounded = int(round_to_base(x, base))
     return rounded
+
+
+# `from utilities import *` imports `charts`, as the notebooks that use it draw charts
+__all__ = [name for name in list(globals()) if not name.startswith("_")] + CHART_NAMES
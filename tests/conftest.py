@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The analysis scripts import each other as top-level modules, as they are run from
+# the analysis directory
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
@@ -0,0 +1,72 @@
+import json
+
+import catalogue
+import pandas
+import pytest
+
+
+@pytest.mark.parametrize(
+    "name,exp",
+    [
+        ("input_2019-01-01.feather", ("monthly", "2019-01-01")),
+        ("input_population_2019-01-01.feather", ("population", "2019-01-01")),
+        ("input_ethnicity.feather", ("ethnicity", None)),
+        ("input_2019-13-01.feather", None),
+        ("measure_asthma_rate.csv", None),
+    ],
+)
+def test_parse_extract_name(name, exp):
+    assert catalogue.parse_extract_name(name) == exp
+
+
+class TestLoadCatalogue:
+    @pytest.fixture
+    def extracts_dir(self, tmp_path):
+        for month in [2, 1]:
+            pandas.DataFrame({"patient_id": [1, 2, 3]}).to_feather(
+                tmp_path / f"input_2019-0{month}-01.feather"
+            )
+        pandas.DataFrame({"patient_id": [1]}).to_feather(
+            tmp_path / "input_ethnicity.feather"
+        )
+        (tmp_path / "measure_asthma_rate.csv").touch()
+        return tmp_path
+
+    def test_get_extracts(self, extracts_dir):
+        obs = catalogue.get_extracts(extracts_dir, "monthly")
+        assert [e["date"] for e in obs] == ["2019-01-01", "2019-02-01"]
+        assert obs[0]["path"] == extracts_dir / "input_2019-01-01.feather"
+        assert obs[0]["num_rows"] == 3
+        assert obs[0]["schema"] == [["patient_id", "int64"]]
+        # the manifest is only written when asked for
+        assert not (extracts_dir / catalogue.MANIFEST_NAME).exists()
+        catalogue.get_extracts(extracts_dir, "monthly", save_manifest=True)
+        assert (extracts_dir / catalogue.MANIFEST_NAME).exists()
+
+    def test_hashes_are_added_when_asked_for(self, extracts_dir):
+        obs = catalogue.load_catalogue(extracts_dir)
+        assert "hash" not in obs["input_2019-01-01.feather"]
+
+        obs = catalogue.load_catalogue(extracts_dir, hash_kinds=["monthly"])
+        assert obs["input_2019-01-01.feather"]["hash"] == catalogue.get_content_hash(
+            extracts_dir / "input_2019-01-01.feather"
+        )
+        assert "hash" not in obs["input_ethnicity.feather"]
+
+    def test_entries_are_reused(self, extracts_dir):
+        catalogue.load_catalogue(
+            extracts_dir, hash_kinds=["monthly"], save_manifest=True
+        )
+
+        # an entry is reused while its size and modification time are unchanged
+        manifest_path = extracts_dir / catalogue.MANIFEST_NAME
+        manifest = json.loads(manifest_path.read_text())
+        manifest["input_2019-01-01.feather"]["hash"] = "reused"
+        manifest_path.write_text(json.dumps(manifest))
+
+        obs = catalogue.load_catalogue(extracts_dir, hash_kinds=["monthly"])
+        assert obs["input_2019-01-01.feather"]["hash"] == "reused"
+
+        (extracts_dir / "input_2019-02-01.feather").unlink()
+        obs = catalogue.load_catalogue(extracts_dir)
+        assert list(obs) == ["input_2019-01-01.feather", "input_ethnicity.feather"]
@@ -0,0 +1,87 @@
+import combine_backends
+import pandas
+from disclosure import Policy
+from pandas import testing
+
+
+def test_category_counts():
+    counts = combine_backends.CategoryCounts()
+    counts.add(pandas.DataFrame({"count": [1, 2]}, index=["b", "a"]))
+    counts.add(pandas.DataFrame({"count": [3, 4, 5]}, index=["c", "b", "b"]))
+    exp = pandas.DataFrame({"count": [2.0, 10.0, 3.0]}, index=["a", "b", "c"])
+    testing.assert_frame_equal(counts.to_frame(), exp)
+
+
+def test_combine_demographics(tmp_path):
+    for backend, regions in [
+        ("emis", ["LONDON COMMISSIONING REGION", "MIDLANDS COMMISSIONING REGION"]),
+        ("tpp", ["London", "East Midlands", "West Midlands"]),
+        ("other", ["London"]),
+    ]:
+        (tmp_path / backend).mkdir()
+        for demographic in combine_backends.DEMOGRAPHICS:
+            if demographic == "region":
+                table = pandas.DataFrame({"count": 100}, index=regions)
+            elif demographic == "ethnicity":
+                table = pandas.DataFrame({"count": [100, 100]}, index=[1, 4])
+            elif demographic == "total":
+                table = pandas.DataFrame({"pop": ["total"], "count": [100]})
+            else:
+                table = pandas.DataFrame({"count": [100]}, index=["a"])
+            table.to_csv(tmp_path / backend / f"{demographic}_count.csv")
+
+    combine_backends.combine_demographics(
+        tmp_path, ["emis", "tpp", "other"], tmp_path, Policy(threshold=10, base=5)
+    )
+
+    region = pandas.read_csv(tmp_path / "region_count.csv", index_col=0)
+    testing.assert_frame_equal(
+        region,
+        pandas.DataFrame({"count": [300.0, 300.0]}, index=["London", "Midlands"]),
+    )
+    # only emis ethnicity is mapped from 16 to 6 categories
+    ethnicity = pandas.read_csv(tmp_path / "ethnicity_count.csv", index_col=0)
+    testing.assert_frame_equal(
+        ethnicity,
+        pandas.DataFrame({"count": [300.0, 100.0, 200.0]}, index=[1, 2, 4]),
+    )
+    total = pandas.read_csv(tmp_path / "total_count.csv", index_col=0)
+    assert total.loc["total", "count"] == 300
+
+
+def test_combine_code_table(tmp_path):
+    for backend, code_counts in [
+        ("emis", {"code": [1, 2, 3], "events": [100, 20, 15]}),
+        ("tpp", {"code": [2, 4], "events": [60, 25]}),
+    ]:
+        (tmp_path / backend).mkdir()
+        pandas.DataFrame(code_counts).to_csv(
+            tmp_path / backend / "code_counts_asthma.csv", index=False
+        )
+
+    combine_backends.combine_code_table(
+        "asthma", tmp_path, ["emis", "tpp"], tmp_path, Policy(threshold=10, base=5)
+    )
+
+    code_table = pandas.read_csv(tmp_path / "code_table_asthma.csv", index_col=0)
+    assert list(code_table["Code"]) == [1, 2, 4, 3]
+    # proportions are of the total of the released counts, so they sum to 100
+    assert list(code_table["Proportion of Codes (%)"]) == [45.45, 36.36, 11.36, 6.82]
+
+
+def test_combine_code_table_outside_top_5(tmp_path):
+    (tmp_path / "emis").mkdir()
+    pandas.DataFrame(
+        {"code": [1, 2, 3, 4, 5, 6, 7], "events": [100, 90, 80, 70, 60, 15, 5]}
+    ).to_csv(tmp_path / "emis" / "code_counts_asthma.csv", index=False)
+
+    combine_backends.combine_code_table(
+        "asthma", tmp_path, ["emis"], tmp_path, Policy(threshold=10, base=5)
+    )
+
+    # code 7 is suppressed, and code 6 is outside the top 5, but the proportions
+    # are still released, as they're of controlled counts
+    code_table = pandas.read_csv(tmp_path / "code_table_asthma.csv", index_col=0)
+    assert list(code_table["Code"]) == [1, 2, 3, 4, 5]
+    proportions = code_table["Proportion of Codes (%)"]
+    assert list(proportions) == [24.1, 21.69, 19.28, 16.87, 14.46]
@@ -0,0 +1,27 @@
+import disclosure
+import numpy
+import pandas
+from pandas import testing
+
+
+def test_round_to_base():
+    obs = disclosure.round_to_base(pandas.Series([12, 13, numpy.nan]), 5)
+    testing.assert_series_equal(obs, pandas.Series([10, 15, numpy.nan]))
+
+
+def test_apply_policy():
+    counts = pandas.Series([0, 7, 12, 13], name="count")
+    obs = disclosure.apply_policy(counts, disclosure.Policy(threshold=10, base=5))
+    exp = pandas.Series([numpy.nan, numpy.nan, 10, 15], name="count")
+    testing.assert_series_equal(obs, exp)
+
+
+def test_apply_policy_with_secondary_suppression():
+    df = pandas.DataFrame({"a": [0, 3, 4, 20], "b": [0, 20, 30, 40]})
+    policy = disclosure.Policy(threshold=5, base=None, secondary=True)
+    obs = disclosure.apply_policy(df, policy, columns=["a", "b"], groups=[0, 0, 0, 0])
+    # 0 and 3 sum to <=5, so 4 is redacted too; a small total of zero isn't redacted
+    exp = pandas.DataFrame(
+        {"a": [numpy.nan, numpy.nan, numpy.nan, 20], "b": [0, 20, 30, 40]}
+    )
+    testing.assert_frame_equal(obs, exp)
@@ -0,0 +1,91 @@
+import numpy
+import pandas
+import pytest
+import sketches
+import utilities
+from pandas import testing
+
+
+def get_rank_errors(values, estimates, quantiles):
+    """Gets how far the ranks of the estimates are from the ranks of the quantiles."""
+    values = numpy.sort(values)
+    target = quantiles * (len(values) - 1)
+    lower = numpy.searchsorted(values, estimates, "left")
+    upper = numpy.searchsorted(values, estimates, "right")
+    return numpy.maximum(0, numpy.maximum(lower - target, target - upper)) / len(values)
+
+
+def test_exact_when_small():
+    values = numpy.random.default_rng(0).random(150)
+    sketch = sketches.KLLSketch(k=200).update(values)
+    quantiles = utilities.get_quantiles()
+    numpy.testing.assert_allclose(
+        sketch.quantiles(quantiles), numpy.quantile(values, quantiles)
+    )
+
+
+def test_ignores_missing_values():
+    sketch = sketches.KLLSketch().update([1.0, numpy.nan, numpy.inf, 3.0])
+    assert sketch.n == 2
+    assert sketch.quantiles([0.5]) == [2.0]
+
+
+def test_empty():
+    assert numpy.isnan(sketches.KLLSketch().quantiles([0.5])).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merged_within_rank_error(seed):
+    rng = numpy.random.default_rng(seed)
+    emis = rng.lognormal(size=3_000).round(1)
+    tpp = rng.lognormal(mean=0.5, size=5_000).round(1)
+    sketch = sketches.KLLSketch().update(emis)
+    sketch.merge(sketches.KLLSketch().update(tpp))
+
+    assert sketch.n == 8_000
+    assert len(sketch) < 3 * sketch.k
+    quantiles = utilities.get_quantiles()
+    errors = get_rank_errors(
+        numpy.concatenate([emis, tpp]), sketch.quantiles(quantiles), quantiles
+    )
+    assert errors.max() <= sketches.get_rank_error(sketch.k)
+
+
+def test_merge_different_k():
+    with pytest.raises(ValueError):
+        sketches.KLLSketch(k=100).merge(sketches.KLLSketch(k=200))
+
+
+def test_save_and_load(tmp_path):
+    values = numpy.random.default_rng(0).random(1_000)
+    saved = {"2019-01-01": sketches.KLLSketch().update(values)}
+    sketches.save_sketches(saved, tmp_path / "sketch.json")
+    loaded = sketches.load_sketches(tmp_path / "sketch.json")
+    assert loaded["2019-01-01"].n == 1_000
+    numpy.testing.assert_array_equal(
+        loaded["2019-01-01"].quantiles([0.1, 0.5]),
+        saved["2019-01-01"].quantiles([0.1, 0.5]),
+    )
+
+
+def test_sketch_deciles_match_compute_deciles():
+    measure_table = pandas.DataFrame(
+        {
+            "date": pandas.to_datetime(["2019-01-01"] * 3 + ["2019-02-01"] * 4),
+            "rate": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0],
+        }
+    )
+    by_backend = [
+        sketches.sketch_by_date(measure_table.iloc[::2], "date", "rate"),
+        sketches.sketch_by_date(measure_table.iloc[1::2], "date", "rate"),
+    ]
+    merged = sketches.merge_sketches(*by_backend)
+    assert list(merged) == ["2019-01-01", "2019-02-01"]
+
+    obs = sketches.get_sketch_deciles(merged)
+    exp = utilities.compute_deciles(measure_table, "date", "rate")
+    testing.assert_frame_equal(
+        obs.sort_values(["date", "percentile"], ignore_index=True),
+        exp.sort_values(["date", "percentile"], ignore_index=True),
+        check_dtype=False,
+    )
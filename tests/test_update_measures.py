@@ -0,0 +1,61 @@
+import sys
+from unittest.mock import patch
+
+import pandas
+import update_measures
+from pandas import testing
+
+
+def make_measures(measures, dates):
+    return pandas.DataFrame(
+        [
+            {
+                "measure": measure,
+                "interval_start": date,
+                "interval_end": date,
+                "ratio": practice / 10,
+                "numerator": practice,
+                "denominator": 10,
+                "practice": practice,
+            }
+            for measure in measures
+            for date in dates
+            for practice in [1, 2, 3]
+        ]
+    )
+
+
+def test_merge_measure_tables():
+    previous = {"asthma_practice": make_measures(["asthma_practice"], ["2019-01-01"])}
+    latest = {"copd_practice": make_measures(["copd_practice"], ["2019-02-01"])}
+    obs = update_measures.merge_measure_tables(previous, latest)
+    assert list(obs) == ["asthma_practice", "copd_practice"]
+    testing.assert_frame_equal(obs["asthma_practice"], previous["asthma_practice"])
+
+
+def test_measure_missing_from_latest_measures(tmp_path):
+    make_measures(
+        ["asthma_practice", "copd_practice"], ["2019-01-01", "2019-02-01"]
+    ).to_csv(tmp_path / "previous.csv", index=False)
+    make_measures(["asthma_practice"], ["2019-03-01"]).to_csv(
+        tmp_path / "latest.csv", index=False
+    )
+
+    argv = [
+        "update_measures.py",
+        "--previous-measures",
+        str(tmp_path / "previous.csv"),
+        "--latest-measures",
+        str(tmp_path / "latest.csv"),
+        "--output-dir",
+        str(tmp_path / "updated"),
+    ]
+    with patch.object(sys, "argv", argv):
+        update_measures.main()
+
+    measures = pandas.read_csv(tmp_path / "updated" / "measures.csv")
+    intervals = measures.groupby("measure")["interval_start"].nunique()
+    assert intervals.to_dict() == {"asthma_practice": 3, "copd_practice": 2}
+    # the measure that wasn't updated is still summarised
+    percentiles = pandas.read_csv(tmp_path / "updated" / "percentiles_copd.csv")
+    assert percentiles["interval_start"].nunique() == 2
@@ -1,12 +1,16 @@
 import json
+from collections import OrderedDict
 from unittest.mock import patch
+
+import charts
+import numpy
 import pandas
+import pyarrow
 import pytest
+import utilities
 from pandas import testing
 from pandas.api.types import is_datetime64_dtype, is_numeric_dtype
 
-from analysis import utilities
-
 
 @pytest.fixture
 def measure_table_from_csv():
@@ -85,7 +89,7 @@ class TestLoadAndDrop:
             obs = utilities.load_and_drop(measure, practice=True)
             assert is_datetime64_dtype(obs.date)
             print(obs.columns.values)
-            assert obs.columns.values.all() in ['rate', 'date']
+            assert obs.columns.values.all() in ["rate", "date"]
 
 
 def test_calculate_rate():
@@ -135,17 +139,8 @@ def test_create_child_table(measure_table, codelist_table_from_csv):
 
     exp = pandas.DataFrame(
         [
-            {
-                "code": 1,
-                "Description": "Code 1",
-                "Proportion of codes (%)": 66.67
-            },
-            {
-                "code": 2,
-                "Description": "Code 2",
-                "Proportion of codes (%)": 33.33 
-                
-            },
+            {"code": 1, "Description": "Code 1", "Proportion of codes (%)": 66.67},
+            {"code": 2, "Description": "Code 2", "Proportion of codes (%)": 33.33},
         ],
     )
 
@@ -155,14 +150,13 @@ def test_create_child_table(measure_table, codelist_table_from_csv):
                 "code": 1,
                 "Description": "Code 1",
                 "Events": 2,
-                "Proportion of codes (%)": 66.67
+                "Proportion of codes (%)": 66.67,
             },
             {
                 "code": 2,
                 "Description": "Code 2",
                 "Events": 1,
-                "Proportion of codes (%)": 33.33 
-                
+                "Proportion of codes (%)": 33.33,
             },
         ],
     )
@@ -170,6 +164,7 @@ def test_create_child_table(measure_table, codelist_table_from_csv):
     testing.assert_frame_equal(obs, exp, check_dtype=False)
     testing.assert_frame_equal(obs_with_count, exp_with_count, check_dtype=False)
 
+
 def test_get_number_practices(measure_table):
     assert utilities.get_number_practices(measure_table) == 2
 
@@ -184,11 +179,11 @@ def test_get_percentage_practices(tmp_path, measure_table):
 
 
 def test_get_number_events_mil(measure_table):
-    _,obs = utilities.get_number_events_mil(
+    _, obs = utilities.get_number_events_mil(
         measure_table,
         "systolic_bp",
     )
-    
+
     assert obs == 0.0
 
 
@@ -229,69 +224,69 @@ def test_compute_deciles(measure_table, has_outer_percentiles, num_rows):
     assert is_numeric_dtype(obs.value)
 
 
-
 input_df_params = [
-    #patient 2 has left. none have joined
+    # patient 2 has left. none have joined
     {
         "obs": {
             "patient_id": pandas.Series([1, 3, 4, 5]),
             "age": pandas.Series([20, 40, 50, 60]),
             "age_start": pandas.Series([20, 40, 50, 60]),
-            "ethnicity": pandas.Series([3, 2, 1, 3])
+            "ethnicity": pandas.Series([3, 2, 1, 3]),
         },
         "exp_joined": {
             "patient_id": pandas.Series([], dtype="int64"),
             "ethnicity": pandas.Series([], dtype="int64"),
-            "ehr_provider": pandas.Series([], dtype="object")
+            "ehr_provider": pandas.Series([], dtype="object"),
         },
         "exp_left": {
             "patient_id": pandas.Series([2]),
             "ethnicity": pandas.Series([4]),
-            "ehr_provider": pandas.Series(["EMIS"])
-        }
+            "ehr_provider": pandas.Series(["EMIS"]),
+        },
     },
-
-    # patient 6 has joined. Patient 7 has joined (but because they fit age criteria). none have left
+    # patient 6 has joined. Patient 7 has joined (but because they fit age criteria).
+    # none have left
     {
         "obs": {
             "patient_id": pandas.Series([1, 2, 3, 4, 5, 6, 7]),
             "age": pandas.Series([20, 30, 40, 50, 60, 70, 18]),
             "age_start": pandas.Series([20, 30, 40, 50, 60, 70, 17]),
-            "ethnicity": pandas.Series([3, 4, 2, 1, 3, 1, 4])
+            "ethnicity": pandas.Series([3, 4, 2, 1, 3, 1, 4]),
         },
         "exp_left": {
             "patient_id": pandas.Series([], dtype="int64"),
             "ethnicity": pandas.Series([], dtype="int64"),
-            "ehr_provider": pandas.Series([], dtype="object")
+            "ehr_provider": pandas.Series([], dtype="object"),
         },
         "exp_joined": {
             "patient_id": pandas.Series([6]),
             "ethnicity": pandas.Series([1]),
-            "ehr_provider": pandas.Series(["TPP"])
-        }
+            "ehr_provider": pandas.Series(["TPP"]),
+        },
     },
-
-    # patient 8 has joined. Patient 7 has joined (but because they fit age criteria). patient 2 has left
+    # patient 8 has joined. Patient 7 has joined (but because they fit age criteria).
+    # patient 2 has left
     {
         "obs": {
             "patient_id": pandas.Series([1, 3, 4, 5, 6, 7, 8]),
             "age": pandas.Series([20, 40, 50, 60, 70, 18, 40]),
             "age_start": pandas.Series([20, 40, 50, 60, 70, 17, 40]),
-            "ethnicity": pandas.Series([3, 2, 1, 3, 1, 4, 5])
+            "ethnicity": pandas.Series([3, 2, 1, 3, 1, 4, 5]),
         },
         "exp_left": {
             "patient_id": pandas.Series([2], dtype="int64"),
             "ethnicity": pandas.Series([4], dtype="int64"),
-            "ehr_provider": pandas.Series(["EMIS"], dtype="object")
+            "ehr_provider": pandas.Series(["EMIS"], dtype="object"),
         },
         "exp_joined": {
             "patient_id": pandas.Series([6, 8]),
             "ethnicity": pandas.Series([1, 5]),
-            "ehr_provider": pandas.Series(["TPP", "TPP"])
-        }
-    }
+            "ehr_provider": pandas.Series(["TPP", "TPP"]),
+        },
+    },
 ]
 
+
 @pytest.fixture()
 def input_df_comparator():
     """Returns an input like dataframe"""
@@ -300,18 +295,688 @@ def input_df_comparator():
             "patient_id": pandas.Series([1, 2, 3, 4, 5]),
             "age": pandas.Series([20, 30, 40, 50, 60]),
             "age_start": pandas.Series([20, 30, 40, 50, 60]),
-            "ethnicity": pandas.Series([3, 4, 2, 1, 3])
+            "ethnicity": pandas.Series([3, 4, 2, 1, 3]),
         }
     )
 
+
 @pytest.mark.parametrize("input_df_params", input_df_params)
 class TestGetMovedPatients:
     def test_get_patients_joined_tpp(self, input_df_params, input_df_comparator):
-        obs = utilities.get_patients_joined_tpp(pandas.DataFrame(input_df_params["obs"]), input_df_comparator, "age", "age_start", ["ethnicity"])
+        obs = utilities.get_patients_joined_tpp(
+            pandas.DataFrame(input_df_params["obs"]),
+            input_df_comparator,
+            "age",
+            "age_start",
+            ["ethnicity"],
+        )
         exp = pandas.DataFrame(input_df_params["exp_joined"])
         pandas.testing.assert_frame_equal(obs, exp)
 
-    def test_get_patients_left_tpp(self,input_df_params, input_df_comparator):
-        obs = utilities.get_patients_left_tpp(pandas.DataFrame(input_df_params["obs"]), input_df_comparator, ["ethnicity"])
+    def test_get_patients_left_tpp(self, input_df_params, input_df_comparator):
+        obs = utilities.get_patients_left_tpp(
+            pandas.DataFrame(input_df_params["obs"]), input_df_comparator, ["ethnicity"]
+        )
         exp = pandas.DataFrame(input_df_params["exp_left"])
         pandas.testing.assert_frame_equal(obs, exp)
+
+
+class TestReadInputFiles:
+    def test_get_input_files(self, tmp_path):
+        for f_name in [
+            "input_2019-02-01.feather",
+            "input_2019-01-01.feather",
+            "input_ethnicity.feather",
+            "input_population_2019-01-01.feather",
+        ]:
+            pandas.DataFrame({"patient_id": [1]}).to_feather(tmp_path / f_name)
+
+        obs = utilities.get_input_files(tmp_path)
+        assert [f.name for f in obs] == [
+            "input_2019-01-01.feather",
+            "input_2019-02-01.feather",
+        ]
+
+        obs = utilities.get_input_files(tmp_path, prefix="input_population")
+        assert [f.name for f in obs] == ["input_population_2019-01-01.feather"]
+
+    def test_read_input_files(self, tmp_path):
+        for month in range(1, 6):
+            pandas.DataFrame(
+                {
+                    "patient_id": pandas.Series([1, 2]),
+                    "practice": pandas.Series([month, month]),
+                }
+            ).to_feather(tmp_path / f"input_2019-0{month}-01.feather")
+
+        obs = list(utilities.read_input_files(["practice"], tmp_path, max_workers=2))
+        assert [f.name for f, _ in obs] == [
+            f"input_2019-0{month}-01.feather" for month in range(1, 6)
+        ]
+        for month, (_, df) in enumerate(obs, start=1):
+            assert list(df.columns) == ["practice"]
+            assert all(df.practice.values == [month, month])
+
+
+def test_redact_small_numbers():
+    df = pandas.DataFrame(
+        {
+            "date": pandas.Series(
+                ["2019-01-01"] * 4 + ["2019-02-01"] * 3 + ["2019-01-01"]
+            ),
+            "numerator": pandas.Series([3, 8, 20, 30, 0, 40, 50, 25]),
+            "denominator": pandas.Series([100, 100, 100, 100, 100, 100, 100, 100]),
+        }
+    )
+    df["rate"] = df["numerator"] / df["denominator"]
+
+    obs = utilities.redact_small_numbers(
+        df, 5, "numerator", "denominator", "rate", "date"
+    )
+
+    # Rows are grouped by date. In January, 3 is redacted, and so is 8, the
+    # next smallest value, because 3 <= 5. In February, nothing is redacted,
+    # because the small values sum to zero.
+    assert list(obs.index) == [0, 1, 2, 3, 7, 4, 5, 6]
+    testing.assert_series_equal(
+        obs["numerator"],
+        pandas.Series(
+            [float("nan"), float("nan"), 20, 30, 25, 0, 40, 50],
+            index=obs.index,
+            name="numerator",
+        ),
+    )
+    assert obs["denominator"].notna().all()
+    assert list(obs["rate"].isna()) == [True, True] + [False] * 6
+
+
+def test_redact_small_numbers_redacts_until_threshold_exceeded():
+    df = pandas.DataFrame(
+        {
+            "date": pandas.Series(["2019-01-01"] * 4),
+            "numerator": pandas.Series([1, 2, 2, 9]),
+            "denominator": pandas.Series([50, 50, 50, 50]),
+        }
+    )
+    df["rate"] = df["numerator"] / df["denominator"]
+
+    obs = utilities.redact_small_numbers(
+        df, 5, "numerator", "denominator", "rate", "date"
+    )
+
+    # 1 + 2 + 2 = 5 <= 5, so 9 must also be redacted
+    assert obs["numerator"].isna().all()
+
+
+def test_compute_deciles_values():
+    mt = pandas.DataFrame(
+        {
+            "date": pandas.to_datetime(["2019-02-01"] * 11 + ["2019-01-01"] * 3),
+            "value": pandas.Series(
+                [10, 0, 9, 1, 8, 2, 7, 3, 6, 4, 5] + [1, float("nan"), 3]
+            ),
+        }
+    )
+    obs = utilities.compute_deciles(mt, "date", "value", has_outer_percentiles=False)
+
+    exp = mt.groupby("date")["value"].quantile([q / 10 for q in range(1, 10)])
+    testing.assert_series_equal(
+        obs["value"], exp.reset_index(drop=True), check_names=False
+    )
+    assert list(obs["percentile"]) == list(range(10, 100, 10)) * 2
+    assert list(obs.loc[obs["date"] == "2019-02-01", "value"]) == list(range(1, 10))
+
+
+class TestGetDeciles:
+    def test_cached(self, measure_table):
+        with patch.object(utilities, "DECILES_CACHE", OrderedDict()):
+            with patch.object(
+                utilities, "compute_deciles", wraps=utilities.compute_deciles
+            ) as compute_deciles:
+                obs_1 = utilities.get_deciles(measure_table, "date", "value")
+                obs_2 = utilities.get_deciles(measure_table.copy(), "date", "value")
+                assert compute_deciles.call_count == 1
+                testing.assert_frame_equal(obs_1, obs_2)
+                assert id(obs_1) != id(obs_2)
+
+                measure_table.loc[0, "value"] = 2
+                utilities.get_deciles(measure_table, "date", "value")
+                assert compute_deciles.call_count == 2
+
+    def test_bounded(self, measure_table):
+        with patch.object(utilities, "DECILES_CACHE", OrderedDict()):
+            for value in range(utilities.DECILES_CACHE_SIZE + 2):
+                measure_table.loc[0, "value"] = value
+                utilities.get_deciles(measure_table, "date", "value")
+            assert len(utilities.DECILES_CACHE) == utilities.DECILES_CACHE_SIZE
+
+    def test_computed_once_per_chart(self, tmp_path, measure_table):
+        with patch.object(utilities, "DECILES_CACHE", OrderedDict()):
+            with patch.object(
+                utilities, "compute_deciles", wraps=utilities.compute_deciles
+            ) as compute_deciles:
+                utilities.deciles_chart(
+                    measure_table,
+                    "date",
+                    "value",
+                    interactive=False,
+                    output_path=tmp_path / "deciles_chart.png",
+                )
+                assert compute_deciles.call_count == 1
+                assert (tmp_path / "deciles_chart.png").exists()
+
+    def test_one_collection_per_style(self, measure_table):
+        plt = utilities.deciles_chart_ebm(
+            measure_table, "date", "value", show_outer_percentiles=True
+        )
+        ax = plt.gca()
+        assert len(ax.lines) == 0
+        assert [len(c.get_segments()) for c in ax.collections] == [18, 8, 1]
+        plt.close("all")
+
+
+def test_get_line_gaps():
+    dates = pandas.to_datetime(["2019-01-01", "2019-02-01"])
+    x, y = charts.get_line_gaps(dates, numpy.array([[1.0, 3.0], [2.0, 4.0]]))
+    assert list(x) == [dates[0], dates[1], None, dates[0], dates[1], None]
+    numpy.testing.assert_array_equal(y, [1.0, 2.0, numpy.nan, 3.0, 4.0, numpy.nan])
+
+
+class TestDecilesFigure:
+    @pytest.fixture
+    def table(self, measure_table):
+        percentiles = utilities.get_deciles(measure_table, "date", "value", True)
+        return charts.pivot_percentiles(percentiles, "date", "value")
+
+    @pytest.mark.parametrize(
+        "outer_percentiles,names",
+        [
+            ("lines", ["median", "deciles", "1st-9th, 91st-99th percentile"]),
+            ("band", ["median", "deciles", "1st-99th percentile"]),
+            (None, ["median", "deciles"]),
+        ],
+    )
+    def test_outer_percentiles(self, table, outer_percentiles, names):
+        fig = charts.get_deciles_figure(table, outer_percentiles=outer_percentiles)
+        assert [trace.name for trace in fig.data] == names
+
+    def test_hover_labels(self, table):
+        fig = charts.get_deciles_figure(table)
+        assert fig.layout.hovermode == "closest"
+        median, deciles, _ = fig.data
+        assert set(median.customdata) == {50}
+        # a point per date and a gap, for each line
+        assert list(deciles.customdata[:: len(table) + 1]) == [
+            10,
+            20,
+            30,
+            40,
+            60,
+            70,
+            80,
+            90,
+        ]
+        assert len(deciles.customdata) == len(deciles.y)
+
+    def test_compact(self, table):
+        fig = charts.get_deciles_figure(table, compact=True, decimals=1)
+        median = fig.data[0]
+        assert median.x[0] == pandas.Timestamp("2019-01-01").value // 10 ** 6
+        numpy.testing.assert_array_equal(median.y, numpy.round(median.y, 1))
+
+    def test_compact_display_figure_doesnt_embed_plotlyjs(self, table):
+        fig = charts.get_deciles_figure(table)
+        with patch.object(charts, "display") as display:
+            charts.display_plotlyjs()
+            charts.display_figure(fig, compact=True)
+        plotlyjs, figure = [call.args[0].data for call in display.call_args_list]
+        assert len(plotlyjs) > 1_000_000
+        assert len(figure) < 1_000_000
+        assert "Plotly.newPlot" in figure
+
+
+@pytest.fixture
+def measures_csv(tmp_path):
+    """Returns the path to an ehrQL measures file."""
+    f_path = tmp_path / "measures.csv"
+    pandas.DataFrame(
+        {
+            "measure": ["asthma_practice"] * 3 + ["asthma_code"] * 2,
+            "interval_start": [
+                "2019-01-01",
+                "2019-01-01",
+                "2019-02-01",
+                "2019-01-01",
+                "2019-02-01",
+            ],
+            "interval_end": [
+                "2019-01-31",
+                "2019-01-31",
+                "2019-02-28",
+                "2019-01-31",
+                "2019-02-28",
+            ],
+            "ratio": [0.5, 0.0, 0.25, 0.001, 0.002],
+            "numerator": [1, 0, 1, 5, 10],
+            "denominator": [2, 2, 4, 5000, 5000],
+            "practice": [1, 2, 1, None, None],
+            "asthma_code": [None, None, None, 123456789012345, 123456789012345],
+        }
+    ).to_csv(f_path, index=False)
+    return f_path
+
+
+class TestMeasuresCSV:
+    def test_read_measures_csv(self, measures_csv):
+        obs = utilities.read_measures_csv(measures_csv, chunksize=2)
+        assert set(obs) == {"asthma_practice", "asthma_code"}
+
+        practice = obs["asthma_practice"]
+        assert "asthma_code" not in practice.columns
+        assert is_datetime64_dtype(practice.interval_start)
+        assert practice.numerator.dtype == "int32"
+        assert practice.ratio.dtype == "float32"
+        assert list(practice.practice) == [1, 2, 1]
+
+        # codes are read as integers, without loss of precision
+        assert list(obs["asthma_code"].asthma_code) == [123456789012345] * 2
+
+    def test_read_measures_csv_with_measures(self, measures_csv):
+        obs = utilities.read_measures_csv(measures_csv, measures=["asthma_code"])
+        assert list(obs) == ["asthma_code"]
+
+    def test_split_measures_csv(self, tmp_path, measures_csv):
+        paths = utilities.split_measures_csv(measures_csv, tmp_path, chunksize=2)
+        obs = utilities.read_split_measure(paths["asthma_practice"])
+        exp = utilities.read_measures_csv(measures_csv)["asthma_practice"]
+        testing.assert_frame_equal(obs, exp, check_categorical=False)
+        assert len(utilities.read_split_measure(paths["asthma_code"])) == 2
+
+    def test_drop_irrelevant_practices_of_split_measure(self, tmp_path, measures_csv):
+        paths = utilities.split_measures_csv(measures_csv, tmp_path)
+        measure_table = utilities.read_split_measure(paths["asthma_practice"])
+        with patch.object(
+            utilities,
+            "get_relevant_practices_mask",
+            wraps=utilities.get_relevant_practices_mask,
+        ) as get_mask:
+            utilities.drop_irrelevant_practices(measure_table, "ratio")
+        # the practice IDs are compared as integers, not as Python objects
+        assert get_mask.call_args.args[0].dtype == numpy.int64
+
+    def test_split_measures_csv_with_empty_first_chunk(self, tmp_path, measures_csv):
+        # the first chunk of asthma_code has no codes
+        df = pandas.read_csv(measures_csv)
+        df.loc[3, "asthma_code"] = None
+        df.to_csv(measures_csv, index=False)
+        paths = utilities.split_measures_csv(measures_csv, tmp_path, chunksize=4)
+        obs = utilities.read_split_measure(paths["asthma_code"])
+        assert obs["asthma_code"].isna().tolist() == [True, False]
+
+
+class TestMeasureCache:
+    def test_write_and_read(self, tmp_path, measure_table):
+        utilities.write_measure_cache(measure_table, "systolic_bp", "rate", tmp_path)
+        utilities.write_measure_cache(measure_table, "asthma", "rate", tmp_path)
+
+        obs = utilities.read_measure_cache("systolic_bp", "rate", cache_dir=tmp_path)
+        testing.assert_frame_equal(obs, measure_table)
+
+        obs = utilities.read_measure_cache(
+            "systolic_bp",
+            "rate",
+            columns=["practice", "date"],
+            filter=utilities.ds.field("date") >= pandas.Timestamp("2019-02-01"),
+            cache_dir=tmp_path,
+        )
+        assert list(obs.columns) == ["practice", "date"]
+        assert list(obs.practice) == [2]
+
+    def test_load_and_drop_reads_cache(self, tmp_path, measure_table_from_csv):
+        with patch.object(utilities, "OUTPUT_DIR", tmp_path):
+            measure = "systolic_bp"
+            f_name = f"measure_{measure}_rate.csv"
+            measure_table_from_csv.to_csv(utilities.OUTPUT_DIR / f_name)
+            measure_table_from_csv["date"] = pandas.to_datetime(
+                measure_table_from_csv["date"]
+            )
+            utilities.write_measure_cache(measure_table_from_csv, measure, "rate")
+
+            with patch.object(utilities.pd, "read_csv") as read_csv:
+                obs = utilities.load_and_drop(measure)
+                read_csv.assert_not_called()
+            assert is_datetime64_dtype(obs.date)
+            assert all(obs.practice.values == [2, 3, 2])
+
+    def test_load_and_drop_reads_cache_without_csv(
+        self, tmp_path, measure_table_from_csv
+    ):
+        with patch.object(utilities, "OUTPUT_DIR", tmp_path):
+            measure = "systolic_bp"
+            measure_table_from_csv["date"] = pandas.to_datetime(
+                measure_table_from_csv["date"]
+            )
+            utilities.write_measure_cache(measure_table_from_csv, measure, "rate")
+            assert not (tmp_path / f"measure_{measure}_rate.csv").exists()
+
+            obs = utilities.load_and_drop(measure)
+            assert all(obs.practice.values == [2, 3, 2])
+
+    def test_load_and_drop_practice_reads_cache(self, tmp_path, measure_table_from_csv):
+        with patch.object(utilities, "OUTPUT_DIR", tmp_path):
+            measure = "systolic_bp"
+            f_name = f"measure_{measure}_practice_only_rate.csv"
+            measure_table_from_csv.to_csv(utilities.OUTPUT_DIR / f_name)
+            measure_table_from_csv["date"] = pandas.to_datetime(
+                measure_table_from_csv["date"]
+            )
+            utilities.write_measure_cache(
+                measure_table_from_csv, measure, "practice_only_rate"
+            )
+
+            obs = utilities.load_and_drop(measure, practice=True)
+            assert list(obs.columns) == ["rate", "date"]
+            assert is_datetime64_dtype(obs.date)
+            # practice #1, which is irrelevant, has been dropped
+            assert len(obs) == 3
+
+
+class TestIncrementalUpdate:
+    def test_append_new_intervals(self):
+        previous = pandas.DataFrame(
+            {
+                "interval_start": pandas.to_datetime(["2019-01-01", "2019-02-01"]),
+                "numerator": pandas.Series([1, 2]),
+            }
+        )
+        latest = pandas.DataFrame(
+            {
+                "interval_start": pandas.to_datetime(["2019-02-01", "2019-03-01"]),
+                "numerator": pandas.Series([20, 3]),
+            }
+        )
+        obs = utilities.append_new_intervals(previous, latest)
+        # the earlier result for 2019-02-01 is kept
+        assert list(obs.numerator) == [1, 2, 3]
+
+    def test_append_new_intervals_with_gap(self):
+        previous = pandas.DataFrame(
+            {"interval_start": pandas.to_datetime(["2019-01-01"])}
+        )
+        latest = pandas.DataFrame(
+            {"interval_start": pandas.to_datetime(["2019-03-01"])}
+        )
+        with pytest.raises(ValueError):
+            utilities.append_new_intervals(previous, latest)
+
+    def test_update_deciles(self, measure_table):
+        previous = utilities.compute_deciles(
+            measure_table[measure_table.date == "2019-01-01"], "date", "value"
+        )
+        previous["value"] = -1  # so we can tell it wasn't recomputed
+
+        obs = utilities.update_deciles(previous, measure_table, "date", "value")
+        assert len(obs) == 54
+        assert (obs.loc[obs.date == "2019-01-01", "value"] == -1).all()
+        assert (obs.loc[obs.date == "2019-02-01", "value"] == 1).all()
+
+
+class TestMeasureMatrix:
+    def test_from_long(self, measure_table_from_csv):
+        obs = utilities.MeasureMatrix.from_long(
+            measure_table_from_csv, "systolic_bp", "population"
+        )
+        assert list(obs.practices) == [1, 2, 3]
+        assert list(obs.dates) == ["2019-01-01", "2019-02-01"]
+        assert obs.numerator.tolist()[:2] == [[0, 0], [1, 1]]
+        # practice #3 has no row for 2019-02-01
+        assert obs.numerator[2, 0] == 1
+        assert pandas.isna(obs.numerator[2, 1])
+
+    def test_to_long(self, measure_table):
+        obs = utilities.MeasureMatrix.from_long(
+            measure_table, "systolic_bp", "population"
+        ).to_long("systolic_bp", "population")
+        exp = measure_table.sort_values(["practice", "date"]).reset_index(drop=True)
+        testing.assert_frame_equal(obs, exp[obs.columns.tolist()], check_dtype=False)
+
+    def test_drop_irrelevant_practices(self, measure_table_from_csv):
+        obs = utilities.MeasureMatrix.from_long(
+            measure_table_from_csv, "systolic_bp", "population"
+        ).drop_irrelevant_practices()
+        assert list(obs.practices) == [2, 3]
+        assert obs.numerator.shape == (2, 2)
+
+    def test_compute_deciles(self, measure_table):
+        utilities.calculate_rate(measure_table, "systolic_bp", "population")
+        obs = utilities.MeasureMatrix.from_long(
+            measure_table, "systolic_bp", "population"
+        ).compute_deciles()
+        exp = utilities.compute_deciles(measure_table, "date", "rate")
+        testing.assert_frame_equal(obs, exp, check_dtype=False)
+
+
+class TestPatientPresence:
+    def test_get_positions(self):
+        presence = utilities.PatientPresence()
+        assert list(presence.get_positions([10, 20, 10])) == [0, 1, 0]
+        assert list(presence.get_positions([30, 10])) == [2, 0]
+
+    def test_left_and_joined(self):
+        presence = utilities.PatientPresence()
+        presence.add_month("2019-01-01", [1, 2, 3])
+        presence.add_month("2019-02-01", [2, 3, 4])
+        presence.add_month("2019-03-01", [3, 4, 5])
+
+        left = presence.get_left("2019-02-01", "2019-01-01") | presence.get_left(
+            "2019-03-01", "2019-01-01"
+        )
+        assert list(presence.to_patient_ids(left)) == [1, 2]
+        joined = presence.get_joined("2019-03-01", "2019-01-01")
+        assert list(presence.to_patient_ids(joined)) == [4, 5]
+        assert list(presence.is_present("2019-02-01", [1, 4, 5])) == [
+            False,
+            True,
+            False,
+        ]
+
+
+class TestLatestRows:
+    @pytest.mark.parametrize("max_bytes", [2 ** 30, 1])
+    def test_iter_latest_rows(self, tmp_path, max_bytes):
+        with utilities.LatestRows(
+            "patient_id", max_bytes=max_bytes, num_buckets=2, spill_dir=tmp_path
+        ) as latest_rows:
+            latest_rows.push(
+                pandas.DataFrame({"patient_id": [1, 2], "sex": ["F", "M"]})
+            )
+            latest_rows.push(
+                pandas.DataFrame({"patient_id": [2, 3], "sex": ["F", "F"]})
+            )
+            obs = pandas.concat(latest_rows.iter_latest_rows())
+
+        obs = obs.sort_values("patient_id").reset_index(drop=True)
+        exp = pandas.DataFrame({"patient_id": [1, 2, 3], "sex": ["F", "F", "F"]})
+        testing.assert_frame_equal(obs, exp)
+
+    def test_concatenate_patients_moved(self):
+        moved = [
+            pandas.DataFrame({"patient_id": range(20), "sex": ["F"] * 12 + ["M"] * 8}),
+            pandas.DataFrame({"patient_id": range(5), "sex": ["M"] * 5}),
+        ]
+        total_moved, dem_counts = utilities.concatenate_patients_moved(moved)
+        assert total_moved == 20
+        # 7 F is suppressed; 13 M is rounded to 15
+        assert dem_counts["sex"]["M"] == 15
+        assert numpy.isnan(dem_counts["sex"]["F"])
+
+
+class TestLookupColumns:
+    def test_append_lookup_columns(self):
+        lookup = utilities.sort_lookup_table(
+            pyarrow.table({"patient_id": [3, 1, 2], "ethnicity": [30, 10, 20]})
+        )
+        table = pyarrow.table({"patient_id": [2, 4, 3, 2]})
+        obs = utilities.append_lookup_columns(table, lookup)
+        assert obs.column_names == ["patient_id", "ethnicity"]
+        assert obs["ethnicity"].to_pylist() == [20, None, 30, 20]
+        # joining again replaces the column
+        assert utilities.append_lookup_columns(obs, lookup).equals(obs)
+
+    def test_sort_lookup_table_with_duplicates(self):
+        with pytest.raises(ValueError):
+            utilities.sort_lookup_table(pyarrow.table({"patient_id": [1, 1]}))
+
+
+class TestExtractSummaries:
+    def test_merge_extract_summaries(self, tmp_path):
+        summaries = [
+            utilities.summarise_extract(
+                pandas.DataFrame(
+                    {
+                        "patient_id": [1, 2, 3],
+                        "practice": [1, 1, 2],
+                        "asthma": [1, 0, 1],
+                    }
+                ),
+                ["asthma"],
+            ),
+            utilities.summarise_extract(
+                pandas.DataFrame(
+                    {"patient_id": [1, 4], "practice": [1, 3], "asthma": [1, 1]}
+                ),
+                ["asthma"],
+            ),
+        ]
+        # summaries are merged the same way after they're saved and loaded
+        utilities.save_extract_summary(summaries[1], tmp_path / "summary.npz")
+        summaries[1] = utilities.load_extract_summary(tmp_path / "summary.npz")
+
+        obs = utilities.merge_extract_summaries(summaries)
+        assert list(obs["practices"]) == [1, 2, 3]
+        assert list(obs["patients"]["asthma"]) == [1, 3, 4]
+        assert obs["events"] == {"asthma": 4}
+
+
+def test_calculate_imd_group():
+    df = pandas.DataFrame(
+        {
+            "date": ["2019-01-01"] * 6,
+            "practice": [1, 1, 1, 1, 2, 2],
+            "imd": [100, 200, 300, 400, 500, 600],
+            "asthma": [1, 0, 1, 1, 0, 1],
+            "population": [1] * 6,
+            "rate": [1000.0, 0, 1000, 1000, 0, 1000],
+        }
+    )
+    imd = df["imd"].copy()
+    bins = utilities.get_imd_quintile_bins(df["imd"])
+
+    obs = utilities.calculate_imd_group(df, "asthma", "rate", bins=bins)
+    testing.assert_series_equal(df["imd"], imd)  # the input isn't changed
+    assert list(obs.columns) == [
+        "date",
+        "imd",
+        "practice",
+        "rate",
+        "asthma",
+        "population",
+    ]
+    # only observed combinations are returned
+    assert list(obs.imd) == ["Most deprived", "2", "3", "4", "Least deprived"]
+    assert list(obs.practice) == [1, 1, 1, 2, 2]
+    assert list(obs.asthma) == [1, 1, 1, 0, 1]
+    assert list(obs.population) == [2, 1, 1, 1, 1]
+
+
+class TestStatistics:
+    @pytest.fixture
+    def rates(self):
+        return pandas.DataFrame(
+            {
+                "date": pandas.to_datetime(
+                    ["2019-04-01", "2019-04-01", "2020-04-01", "2021-04-01"]
+                ),
+                "rate": [10, 30, 10, 19],
+            }
+        )
+
+    def test_calculate_statistics(self, rates):
+        obs = utilities.calculate_statistics(
+            rates, "2019-04-01", ["2020-04-01", "2021-04-01"]
+        )
+        assert obs == (20, [10, 19], [-50, -5])
+
+    def test_calculate_statistics_table(self, rates):
+        obs = utilities.calculate_statistics_table(
+            {"asthma": rates, "copd": rates.assign(rate=rates.rate * 2)},
+            "2019-04-01",
+            ["2020-04-01", "2021-04-01"],
+        )
+        assert list(obs.measure) == ["asthma", "asthma", "copd", "copd"]
+        assert list(obs.baseline) == [20, 20, 40, 40]
+        assert list(obs.value) == [10, 19, 20, 38]
+        assert list(obs.change) == [-50, -5, -50, -5]
+        assert list(obs.classification) == ["recovery"] * 4
+
+    def test_calculate_statistics_table_with_repeated_date(self, rates):
+        obs = utilities.calculate_statistics_table(
+            {"asthma": rates}, "2019-04-01", ["2020-04-01", "2020-04-01", "2019-04-01"]
+        )
+        assert list(obs.baseline) == [20, 20, 20]
+        assert list(obs.value) == [10, 10, 20]
+        assert list(obs.change) == [-50, -50, 0]
+
+
+def test_get_change_classifications():
+    obs = utilities.get_change_classifications(
+        [0, 20, -20, -20, numpy.nan], [0, 0, -20, 0, 0]
+    )
+    assert list(obs) == ["no change", "increase", "sustained drop", "recovery", "none"]
+
+
+class TestCodeCounts:
+    def test_get_code_counts(self):
+        df = pandas.DataFrame(
+            {
+                "asthma_event_code": [3.0, 1.0, 3.0, 2.0, numpy.nan],
+                "asthma": [1, 2, 4, 0, 1],
+            }
+        )
+        codes, counts = utilities.get_code_counts(df, "asthma_event_code", "asthma")
+        numpy.testing.assert_array_equal(codes, [1, 3])
+        numpy.testing.assert_array_equal(counts, [2, 5])
+
+    def test_merge_code_counts(self):
+        emis = (numpy.array([1, 4, 199711000000104]), numpy.array([10, 20, 30]))
+        tpp = (numpy.array([2, 4]), numpy.array([5, 6]))
+        codes, counts = utilities.merge_code_counts(emis, tpp)
+        numpy.testing.assert_array_equal(codes, [1, 2, 4, 199711000000104])
+        numpy.testing.assert_array_equal(counts, [10, 5, 26, 30])
+
+    def test_merge_empty_code_counts(self):
+        empty = (numpy.array([], dtype=int), numpy.array([], dtype=int))
+        codes, counts = utilities.merge_code_counts(empty, empty)
+        assert len(codes) == len(counts) == 0
+
+    def test_apply_code_counts_policy(self):
+        codes = numpy.array([1, 2, 3, 199711000000104])
+        counts = numpy.array([10, 11, 13, 1234])
+        codes, counts = utilities.apply_code_counts_policy(
+            codes, counts, utilities.Policy(threshold=10, base=5)
+        )
+        numpy.testing.assert_array_equal(codes, [2, 3, 199711000000104])
+        numpy.testing.assert_array_equal(counts, [10, 15, 1235])
+
+    def test_save_and_load(self, tmp_path):
+        codes = numpy.array([1, 199711000000104])
+        counts = numpy.array([3, 4])
+        utilities.save_code_counts(codes, counts, tmp_path / "code_counts.csv")
+        obs_codes, obs_counts = utilities.load_code_counts(tmp_path / "code_counts.csv")
+        numpy.testing.assert_array_equal(obs_codes, codes)
+        numpy.testing.assert_array_equal(obs_counts, counts)
+
+    def test_load_codelist_terms(self):
+        terms = utilities.load_codelist_terms("medication_review")
+        assert terms.index.is_unique
+        assert not terms.str.endswith("(procedure)").any()